@@ -4,70 +4,340 @@
 import json
 import datetime
 import getopt
+import os
+import pickle
+import struct
 import sys
+import time
 
 # Language output constants
 CLANG = 0
 MLANG = 1
 JSON  = 2
+CPPLANG = 3
 
-# Default
-lang = CLANG
+TYPES = ["int", "float", "string", "u8", "i8", "u16", "i16", "u32", "i32", "u64", "i64", "double"]
 
-tab = "    "
-nl = "\n"
+# Numeric types, which can also be array elements, with their C type and size
+C_TYPES = {"int":"int", "float":"float", "double":"double",
+    "u8":"uint8_t", "i8":"int8_t", "u16":"uint16_t", "i16":"int16_t",
+    "u32":"uint32_t", "i32":"int32_t", "u64":"uint64_t", "i64":"int64_t"}
+TYPE_SIZES = {"int":4, "float":4, "double":8,
+    "u8":1, "i8":1, "u16":2, "i16":2, "u32":4, "i32":4, "u64":8, "i64":8}
+# Explicitly sized types, which Mercury reads and writes through generated helpers
+SIZED_TYPES = ["u8", "i8", "u16", "i16", "u32", "i32", "u64", "i64", "double"]
+# Mercury has no sized numbers, so sized values use its int and float. u64
+# values above the range of int wrap around.
+MERCURY_TYPES = {"int":"int", "float":"float", "double":"float",
+    "u8":"int", "i8":"int", "u16":"int", "i16":"int",
+    "u32":"int", "i32":"int", "u64":"int", "i64":"int"}
 
-TYPES = ["int", "float", "string"]
+# Buffered writer context, shared by every generated header
+c_writer_decls = """
+#ifndef BOTTLE_WRITER
+#define BOTTLE_WRITER
+#ifndef BOTTLE_WRITER_SIZE
+#define BOTTLE_WRITER_SIZE 65536
+#endif
+
+#if defined(__cplusplus) || (defined(__STDC_VERSION__) && __STDC_VERSION__ >= 199901L)
+#define BOTTLE_INLINE static inline
+#elif defined(__GNUC__)
+#define BOTTLE_INLINE static __inline__
+#else
+#define BOTTLE_INLINE static
+#endif
+
+struct BottleWriter {
+    FILE *to;
+    unsigned len;
+    unsigned status;
+    unsigned char buf[BOTTLE_WRITER_SIZE];
+};
+
+BOTTLE_INLINE void Bottle_InitWriter(struct BottleWriter *w, FILE *to){
+    w->to = to;
+    w->len = 0;
+    w->status = BOTTLE_OK;
+}
+
+/* Writes out everything buffered so far. Returns BOTTLE_FAIL if this or any
+ * earlier write failed. */
+BOTTLE_INLINE unsigned Bottle_FlushWriter(struct BottleWriter *w){
+    if(w->len != 0 && fwrite(w->buf, 1, w->len, w->to) != w->len)
+        w->status = BOTTLE_FAIL;
+    w->len = 0;
+    return w->status;
+}
+#endif
+
+"""
+
+# Only written to files that have arrays, the only payloads big enough to
+# bypass the buffer.
+c_writer_put = """
+#ifdef BOTTLE_HAS_WRITEV
+static unsigned bottle_writev_all(int fd, struct iovec *iov, int n){
+    while(n != 0){
+        const ssize_t written = writev(fd, iov, n);
+        size_t left;
+        if(written < 0)
+            return BOTTLE_FAIL;
+        left = written;
+        while(n != 0 && left >= iov->iov_len){
+            left -= iov->iov_len;
+            iov++;
+            n--;
+        }
+        if(n != 0){
+            iov->iov_base = (char*)iov->iov_base + left;
+            iov->iov_len -= left;
+        }
+    }
+    return BOTTLE_OK;
+}
+#endif
+
+static void bottle_writer_put(struct BottleWriter *w, const void *data, unsigned len){
+    if(len == 0)
+        return;
+#ifdef BOTTLE_HAS_WRITEV
+    if(len >= BOTTLE_WRITEV_MIN){
+        struct iovec iov[2];
+        iov[0].iov_base = w->buf;
+        iov[0].iov_len = w->len;
+        iov[1].iov_base = (void*)data;
+        iov[1].iov_len = len;
+        if(fflush(w->to) != 0 || bottle_writev_all(fileno(w->to), iov, 2) != BOTTLE_OK)
+            w->status = BOTTLE_FAIL;
+        w->len = 0;
+        return;
+    }
+#endif
+    if(w->len + len <= BOTTLE_WRITER_SIZE){
+        memcpy(w->buf + w->len, data, len);
+        w->len += len;
+    }
+    else if(Bottle_FlushWriter(w) == BOTTLE_OK && fwrite(data, 1, len, w->to) != len){
+        w->status = BOTTLE_FAIL;
+    }
+}
+
+"""
+
+c_skip_file = """
+/* Skips n bytes of a stream, seeking when the stream allows it. */
+static unsigned bottle_skip_file(FILE *from, unsigned long n){
+    unsigned char buf[512];
+    if(n <= LONG_MAX && fseek(from, (long)n, SEEK_CUR) == 0)
+        return BOTTLE_OK;
+    while(n != 0){
+        const size_t chunk = n < sizeof(buf) ? n : sizeof(buf);
+        if(fread(buf, 1, chunk, from) != chunk)
+            return BOTTLE_FAIL;
+        n -= chunk;
+    }
+    return BOTTLE_OK;
+}
+
+"""
+
+# JSON output, used by the Dump and Stream functions of every block.
+c_json = """
+/* Returns the length of the UTF-8 sequence at str, or 0 if it is not valid. */
+BOTTLE_INLINE unsigned bottle_utf8_length(const unsigned char *str, unsigned len){
+    unsigned n, i;
+    unsigned long c;
+    if(str[0] >= 0xC2 && str[0] < 0xE0){ n = 2; c = str[0] & 0x1F; }
+    else if(str[0] >= 0xE0 && str[0] < 0xF0){ n = 3; c = str[0] & 0x0F; }
+    else if(str[0] >= 0xF0 && str[0] < 0xF5){ n = 4; c = str[0] & 0x07; }
+    else return 0;
+    if(len < n)
+        return 0;
+    for(i = 1; i < n; i++){
+        if((str[i] & 0xC0) != 0x80)
+            return 0;
+        c = (c << 6) | (str[i] & 0x3F);
+    }
+    /* Overlong forms, surrogates and values past U+10FFFF are not valid. */
+    if((n == 3 && c < 0x800) || (n == 4 && c < 0x10000) || (c >= 0xD800 && c < 0xE000) || c > 0x10FFFF)
+        return 0;
+    return n;
+}
+
+/* UTF-8 is copied as it is, and bytes that are not valid UTF-8 are written as U+FFFD. */
+BOTTLE_INLINE void bottle_json_string(FILE *to, const unsigned char *str, unsigned len){
+    unsigned i;
+    fputc('"', to);
+    for(i = 0; i < len; i++){
+        if(str[i] == '"' || str[i] == '\\\\'){
+            fputc('\\\\', to);
+            fputc(str[i], to);
+        }
+        else if(str[i] < 0x20)
+            fprintf(to, "\\\\u%04x", str[i]);
+        else if(str[i] < 0x80)
+            fputc(str[i], to);
+        else{
+            const unsigned n = bottle_utf8_length(str + i, len - i);
+            if(n == 0)
+                fputs("\\\\ufffd", to);
+            else{
+                fwrite(str + i, 1, n, to);
+                i += n - 1;
+            }
+        }
+    }
+    fputc('"', to);
+}
+
+/* JSON has no NaN or infinities, so they are written as null. */
+BOTTLE_INLINE void bottle_json_number(FILE *to, double v, int digits){
+    if(v != v || v - v != 0)
+        fputs("null", to);
+    else
+        fprintf(to, "%.*g", digits, v);
+}
+
+/* Values outside the enum are written as numbers. */
+BOTTLE_INLINE void bottle_json_enum(FILE *to, const char *const *names, unsigned count, unsigned value){
+    if(value < count)
+        fprintf(to, "\\"%s\\"", names[value]);
+    else
+        fprintf(to, "%u", value);
+}
+
+"""
 
 c_preamble = """
+#include <limits.h>
 #include <stdlib.h>
 #include <string.h>
 
+#if (defined(__unix__) || defined(__APPLE__)) && !defined(BOTTLE_NO_WRITEV)
+#include <sys/uio.h>
+#include <unistd.h>
+#define BOTTLE_HAS_WRITEV 1
+#endif
+
+/* Payloads at least this big are not copied into a BottleWriter's buffer,
+ * they are written together with it using writev where available. */
+#ifndef BOTTLE_WRITEV_MIN
+#define BOTTLE_WRITEV_MIN 4096
+#endif
+
+/* The array loaders prefetch this many bytes ahead of the record being read.
+ * Define BOTTLE_NO_PREFETCH to turn prefetching off. */
+#ifndef BOTTLE_PREFETCH_DISTANCE
+#define BOTTLE_PREFETCH_DISTANCE 512
+#endif
+#if (defined(__GNUC__) || defined(__clang__)) && !defined(BOTTLE_NO_PREFETCH)
+#define BOTTLE_PREFETCH(p) __builtin_prefetch((p), 0, 0)
+#else
+#define BOTTLE_PREFETCH(p) ((void)(p))
+#endif
+
+/* The size of a children variant in its table, when it isn't always the same. */
+#define BOTTLE_VARIABLE_SIZE UINT_MAX
+
+/* Returns space for len bytes in the writer's buffer, flushing it first if
+ * needed. len must not be more than BOTTLE_WRITER_SIZE. */
+static unsigned char *bottle_writer_reserve(struct BottleWriter *w, unsigned len){
+    unsigned char *at;
+    if(w->len + len > BOTTLE_WRITER_SIZE)
+        Bottle_FlushWriter(w);
+    at = w->buf + w->len;
+    w->len += len;
+    return at;
+}
+
+
 static unsigned bottle_read_string_file(FILE *from, struct BottleString *to){
-    const unsigned len = fgetc(from);
-    to->len = len;
+    const int len = fgetc(from);
+    if(len == EOF)
+        return BOTTLE_FAIL;
+    to->len = to->cap = len;
     to->str = (char*)malloc(len);
     {
-        const unsigned nread = fread(to->str, 1, len, from);
-        if(nread == len)
+        const unsigned nread = len == 0 ? 0 : fread(to->str, 1, len, from);
+        if(nread == (unsigned)len)
             return BOTTLE_OK;
         else
             return BOTTLE_FAIL;
     }
 }
 
-static unsigned bottle_read_string_mem(const void *from_v, unsigned from_len,
-    const unsigned at, unsigned *const len_to, struct BottleString *to){
+static unsigned bottle_read_string_mem(const unsigned char *from, unsigned from_len,
+    unsigned *at, struct BottleString *to){
     
-    unsigned i = at;
-    const unsigned char *const from = from_v;
+    unsigned i = at[0];
     
-    if(from_len <= i + 1)
+    if(from_len < i + 1)
         return BOTTLE_FAIL;
     else{
         const unsigned len = from[i++];
-        if(from_len <= i + len)
+        if(from_len < i + len)
             return BOTTLE_FAIL;
-        to->len = len;
+        to->len = to->cap = len;
         to->str = (char*)malloc(len);
-        memcpy(to->str, from + i, len);
-        len_to[0] = len;
+        if(len != 0)
+            memcpy(to->str, from + i, len);
+        at[0] = i + len;
+    }
+    
+    return BOTTLE_OK;
+}
+
+/* Makes room for len bytes, only allocating when the string is too small */
+static unsigned bottle_reserve_string(struct BottleString *to, unsigned len){
+    if(to->cap < len){
+        char *const str = (char*)realloc(to->str, len);
+        if(str == NULL)
+            return BOTTLE_FAIL;
+        to->str = str;
+        to->cap = len;
     }
+    to->len = len;
+    return BOTTLE_OK;
+}
+
+static unsigned bottle_reload_string_file(FILE *from, struct BottleString *to){
+    const int len = fgetc(from);
+    if(len == EOF || bottle_reserve_string(to, len) != BOTTLE_OK)
+        return BOTTLE_FAIL;
+    if(len != 0 && fread(to->str, 1, len, from) != (unsigned)len)
+        return BOTTLE_FAIL;
+    return BOTTLE_OK;
+}
+
+static unsigned bottle_reload_string_mem(const unsigned char *from, unsigned from_len,
+    unsigned *at, struct BottleString *to){
     
+    unsigned i = at[0];
+    unsigned len;
+    if(from_len < i + 1)
+        return BOTTLE_FAIL;
+    len = from[i++];
+    if(from_len < i + len || bottle_reserve_string(to, len) != BOTTLE_OK)
+        return BOTTLE_FAIL;
+    if(len != 0)
+        memcpy(to->str, from + i, len);
+    at[0] = i + len;
     return BOTTLE_OK;
 }
 
 static void bottle_write_string_file(FILE *to, const struct BottleString *from){
     fputc(from->len, to);
-    fwrite(from->str, 1, from->len, to);
+    if(from->len != 0)
+        fwrite(from->str, 1, from->len, to);
 }
 
-static void bottle_write_string_mem(void *to_v, unsigned *at,
+static void bottle_write_string_mem(unsigned char *to, unsigned *at,
     const struct BottleString *from){
 
-    unsigned char *const to = to_v;
     to[*at] = from->len;
-    memcpy(to + 1, from->str, from->len);
+    if(from->len != 0)
+        memcpy(to + *at + 1, from->str, from->len);
     at[0] += from->len+1;
 }
 
@@ -93,23 +363,181 @@ def capitalize(name):
     
     return out
 
-def calcTabs(tabs):
-    tabn = ""
-    i = 0
-    while i < tabs:
-        tabn += tab
-        i += 1
-    return tabn
+# Raised by writers for invalid schemas, reported by generate()
+class BottleError(Exception):
+    pass
+
+# Schema compilation. The parsed JSON is validated once and turned into plain
+# dicts and lists that every writer consumes, so the wire layout is decided in
+# one place. The layout is the one the C code has always used: fields in
+# sorted order, enum fields as 4 bytes, then a 1 byte children tag holding the
+# index of the variant in the sorted enum, then the child block.
+
+def isString(value):
+    return type(value) is str or type(value) is unicode
+
+def compileVariable(variable_name, variable_body, enums):
+    output = {"name":str(variable_name), "type":"", "attr":{}}
+    if isString(variable_body):
+        output["type"] = str(variable_body)
+    elif type(variable_body) is dict:
+        if not "type" in variable_body:
+            raise BottleError("Variable " + output["name"] + " has no type")
+        if not isString(variable_body["type"]):
+            raise BottleError("Invalid type for " + output["name"] + ": " + json.dumps(variable_body["type"]))
+        output["type"] = str(variable_body["type"])
+        if (output["type"] == "string") and ("len" in variable_body):
+            output["attr"]["len"] = variable_body["len"]
+        if variable_body.get("array", False):
+            if not (output["type"] in TYPE_SIZES):
+                raise BottleError("Arrays of " + output["type"] + " are not supported (" + output["name"] + ")")
+            output["attr"]["array"] = True
+    else:
+        raise BottleError("Invalid variable " + output["name"] + ": " + str(type(variable_body)))
+
+    # kind is one of string, array, enum or fixed. size is the encoded size,
+    # or the element size for arrays, and None for strings.
+    t = output["type"]
+    if "array" in output["attr"]:
+        output["kind"] = "array"
+        output["size"] = TYPE_SIZES[t]
+    elif t == "string":
+        output["kind"] = "string"
+        output["size"] = None
+    elif t in enums:
+        if len(enums[t]) == 0:
+            raise BottleError(output["name"] + " uses " + t + ", which has no values")
+        output["kind"] = "enum"
+        output["size"] = 4
+    elif t in TYPE_SIZES:
+        output["kind"] = "fixed"
+        output["size"] = TYPE_SIZES[t]
+    else:
+        raise BottleError("Invalid type " + t + " for " + output["name"])
+    return output
+
+# A block has its fields in wire order, and its children or None. A field's
+# offset counts from the end of the last string or array before it, or from
+# the start of the block, and is what every writer lays fields out by. size is
+# the encoded size when it never varies, and shape identifies blocks with
+# identical bodies.
+def compileBlock(block_name, block, enums):
+    if not (type(block) is dict):
+        raise BottleError("Invalid block " + str(block_name))
+    output = {"name":str(block_name), "fields":[], "children":None,
+        "shape":json.dumps(block, sort_keys = True)}
+    offset = 0
+    fixed = True
+    for key in sorted(block.keys()):
+        if key == "children":
+            continue
+        var = compileVariable(key, block[key], enums)
+        var["offset"] = offset
+        if var["kind"] == "string" or var["kind"] == "array":
+            offset = 0
+            fixed = False
+        else:
+            offset += var["size"]
+        output["fields"].append(var)
+    if "children" in block:
+        output["children"] = compileChildren(block_name, block["children"], enums)
+        fixed = False
+    output["size"] = None
+    if fixed:
+        output["size"] = offset
+    output["empty"] = len(block) == 0
+    return output
+
+# Variants are sorted by name, and tag is the value written for each.
+def compileChildren(block_name, children, enums):
+    if not (type(children) is dict) or not ("enum" in children):
+        raise BottleError("Children of " + str(block_name) + " have no enum")
+    enum_name = str(children["enum"])
+    if not (enum_name in enums):
+        raise BottleError("Invalid enumeration value: " + enum_name)
+    values = enums[enum_name]
+    if len(values) == 0:
+        raise BottleError("Children of " + str(block_name) + " use " + enum_name + ", which has no values")
+    variants = []
+    for key in sorted(children.keys()):
+        if key == "enum":
+            continue
+        if not (key in values):
+            raise BottleError("Child " + str(key) + " of " + str(block_name) + " is not a value of " + enum_name)
+        variants.append({"name":str(key), "tag":values.index(key),
+            "block":compileBlock(key, children[key], enums)})
+    return {"enum":enum_name, "variants":variants}
+
+def compileSchema(schema):
+    enums = {}
+    enum_list = []
+    if not (type(schema.get("enums", {})) is dict):
+        raise BottleError("enums must be an object")
+    if not (type(schema.get("blocks", {})) is dict):
+        raise BottleError("blocks must be an object")
+    for enum_name in schema.get("enums", {}):
+        values = schema["enums"][enum_name]
+        if not (type(values) is list) or not all([isString(e) for e in values]):
+            raise BottleError("Enum " + str(enum_name) + " must be a list of strings")
+        values = [str(e) for e in sorted(values)]
+        enums[str(enum_name)] = values
+        enum_list.append({"name":str(enum_name), "values":values})
+    blocks = []
+    for block_name in schema.get("blocks", {}):
+        blocks.append(compileBlock(block_name, schema["blocks"][block_name], enums))
+    return {"name":str(schema.get("name", "")), "enums":enum_list, "blocks":blocks,
+        "has_enums":"enums" in schema, "has_blocks":"blocks" in schema}
 
 # Base Writer
 class Writer:
-    def __init__(self, name):
+    def __init__(self, name, tab = "    ", nl = "\n", out_dir = "."):
         self.name = name
         self.enums = []
+        self.tab = tab
+        self.nl = nl
+        self.out_dir = out_dir
+        self.outputs = []
+        self.files = []
     
     def getName(self):
         return self.name
     
+    def outputPath(self, file_name):
+        path = os.path.join(self.out_dir, file_name)
+        self.outputs.append(path)
+        return path
+
+    # Outputs are written next to their final path, and only moved into place
+    # by commit(), so a failure never leaves an earlier output half-written.
+    def openOutput(self, file_name):
+        output = open(self.outputPath(file_name) + ".tmp", "wb")
+        self.files.append(output)
+        return output
+
+    def commit(self):
+        for output in self.files:
+            output.close()
+        for path in self.outputs:
+            if os.name == "nt" and os.path.exists(path):
+                os.remove(path)
+            os.rename(path + ".tmp", path)
+
+    # Closes and removes whatever commit() didn't move into place.
+    def discard(self):
+        for output in self.files:
+            output.close()
+        for path in self.outputs:
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+
+    def calcTabs(self, tabs):
+        tabn = ""
+        i = 0
+        while i < tabs:
+            tabn += self.tab
+            i += 1
+        return tabn
+    
     def beginEnums(self):
         pass
     
@@ -122,60 +550,48 @@ class Writer:
     def endBlocks(self):
         pass
 
-    def getVariable(self, variable_name, variable_body):
-        output = {"name":str(variable_name), "type":"", "attr":{}}
-        if type(variable_body) is str or type(variable_body) is unicode:
-            output["type"] = str(variable_body)
-        elif type(variable_body) is dict:
-            if not "type" in variable_body:
-                print variable_body
-            output["type"] = variable_body["type"]
-            if (output["type"] == "string") and ("len" in variable_body):
-                output["attr"]["len"] = variable_body["len"]
-        else:
-            print type(variable_body)
-        return output
-
 # JSON Writer, outputs an equivalent JSON file as its input
 class JSONWriter(Writer):
-    def __init__(self, name):
-        Writer.__init__(self, name)
+    def __init__(self, name, tab = "    ", nl = "\n", out_dir = "."):
+        Writer.__init__(self, name, tab, nl, out_dir)
+        self.blocks = 0
     
     def quote(self, str0, suffix = "", output = None):
         if output == None:
             output = self.output
-        output.write('"' + str(str0) + '"' + suffix)
+        output.write(json.dumps(str(str0)) + suffix)
     
     def open(self, name):
-        self.output = open(name + ".json", "wb")
-        self.output.write('{' + nl + tab + '"name":"' + name + '",')
+        self.output = self.openOutput(name + ".json")
+        self.output.write('{' + self.nl + self.tab + '"name":')
+        self.quote(name)
 
     def close(self):
-        self.output.write('}')
+        self.output.write(self.nl + '}' + self.nl)
         self.output.close()
     
     def beginEnums(self):
-        self.output.write(nl + tab + '"enums":{' + nl)
+        self.output.write(',' + self.nl + self.tab + '"enums":{')
 
     def endEnums(self):
-        self.output.write(tab + "}," + nl)
+        self.output.write(self.nl + self.tab + "}")
     
-    def writeEnum(self, enum_name, enumeration):
-        self.enums.append(str(enum_name))
-        self.output.write(tab + tab)
+    def writeEnum(self, enum):
+        self.enums.append(enum["name"])
         if len(self.enums) != 1:
             self.output.write(',')
-        self.quote(enum_name, ":[")
-        if len(enumeration) > 0:
-            values = sorted(enumerations)
-            self.output.write(nl + tab + tab + tab)
+        self.output.write(self.nl + self.tab + self.tab)
+        self.quote(enum["name"], ":[")
+        if len(enum["values"]) > 0:
+            values = enum["values"]
+            self.output.write(self.nl + self.tab + self.tab + self.tab)
             for e in values[:-1]:
-                self.quote(e, ',' + nl)
-                self.output.write(tab + tab + tab)
+                self.quote(e, ',' + self.nl)
+                self.output.write(self.tab + self.tab + self.tab)
             self.quote(values[-1])
-            self.output.write(nl + tab + tab)
+            self.output.write(self.nl + self.tab + self.tab)
         
-        self.output.write("]" + nl)
+        self.output.write("]")
     
     def writeVariable(self, var):
         self.quote(var["name"], ':')
@@ -184,326 +600,1546 @@ class JSONWriter(Writer):
         else:
             self.output.write('{"type":')
             self.quote(var["type"])
-            for key, val in var["attr"]:
+            for key, val in var["attr"].items():
                 self.output.write(',')
                 self.quote(key, ':')
-                self.quote(val)
+                self.output.write(json.dumps(val))
             self.output.write('}')
 
     def beginBlocks(self):
-        self.output.write(tab + '"blocks":{' + nl)
+        self.output.write(',' + self.nl + self.tab + '"blocks":{')
     
     def endBlocks(self):
-        self.output.write(tab + "}" + nl)
+        self.output.write(self.nl + self.tab + "}")
     
     def writeChildren(self, children, tabs):
-        tabn = calcTabs(tabs)
-        
-        if not (str(children["enum"]) in self.enums):
-            print ("Invalid enumeration value: " + str(children["enum"]))
-            quit()
+        tabn = self.calcTabs(tabs)
         
         self.output.write(tabn)
         self.output.write('"children":{ "enum":')
-        self.quote(children["enum"], ',' + nl)
-        
-        l = len(children)
-        i = 0
+        self.quote(children["enum"])
         
-        keys = children.keys()
-        keys.sort()
-        for key in keys:
-            i += 1
-            if key == "enum":
-                continue
-            self.writeBlock(str(key), children[key], tabs + 1)
-            if i != l:
-                self.output.write(',')
-            self.output.write(nl)
-        self.output.write(tabn + "}")
+        for variant in children["variants"]:
+            self.output.write(',' + self.nl)
+            self.writeBlockBody(variant["block"], tabs + 1)
+        self.output.write(self.nl + tabn + "}")
     
-    def writeBlock(self, block_name, block, tabs=2):
-        tabn = calcTabs(tabs)
+    def writeBlockBody(self, block, tabs):
+        tabn = self.calcTabs(tabs)
         
         self.output.write(tabn)
-        self.quote(block_name, ':{' + nl)
-        l = len(block)
-        i = 0
-        keys = block.keys()
-        keys.sort()
-        for key in keys:
-            i += 1
-            if key == "children":
-                self.writeChildren(block["children"], tabs + 1)
-
-            else:
-                var = getVariable(key, block[key])
-                self.output.write(tabn + tab)
-                self.writeVariable(var)
-            if i != l:
-                self.output.write(',')
-            self.output.write(nl)
+        self.quote(block["name"], ':{' + self.nl)
+        first = True
+        for var in block["fields"]:
+            if not first:
+                self.output.write(',' + self.nl)
+            first = False
+            self.output.write(tabn + self.tab)
+            self.writeVariable(var)
+        if block["children"] != None:
+            if not first:
+                self.output.write(',' + self.nl)
+            first = False
+            self.writeChildren(block["children"], tabs + 1)
+        if not first:
+            self.output.write(self.nl)
         self.output.write(tabn + "}")
 
+    def writeBlock(self, block):
+        if self.blocks != 0:
+            self.output.write(',')
+        self.blocks += 1
+        self.output.write(self.nl)
+        self.writeBlockBody(block, 2)
+
 # C Writer
 class CWriter(Writer):
-    def __init__(self, name):
-        Writer.__init__(self, name)
+    def __init__(self, name, tab = "    ", nl = "\n", out_dir = ".", out_of_line = None, project = None):
+        Writer.__init__(self, name, tab, nl, out_dir)
+        self.out_of_line = []
+        if out_of_line != None:
+            self.out_of_line = list(out_of_line)
+        self.project = {}
+        if project != None:
+            self.project = dict(project)
+        self.shapes = {}
+        self.struct_names = []
+        self.skippers = []
+        self.wrote_writer_put = False
+        self.wrote_skip_file = False
+        self.wrote_json = False
+        self.enum_defs = {}
+        self.name_tables = []
     
     def open(self, name):
-        self.c = open(name + ".c", "wb")
-        self.c.write('#include "' + name + '.h"' + nl)
+        self.c = self.openOutput(name + ".c")
+        self.c.write("/* For fileno, used with writev */" + self.nl)
+        self.c.write("#if (defined(__unix__) || defined(__APPLE__)) && !defined(_POSIX_C_SOURCE)" + self.nl)
+        self.c.write("#define _POSIX_C_SOURCE 200112L" + self.nl)
+        self.c.write("#endif" + self.nl)
+        self.c.write('#include "' + name + '.h"' + self.nl)
         self.c.write(c_preamble)
-        self.h = open(name + ".h", "wb")
+        self.h = self.openOutput(name + ".h")
                 
-        self.h.write("#pragma once" + nl)
-        self.h.write("/* AUTOGENERATED, DO NOT EDIT" + nl)
+        self.h.write("#pragma once" + self.nl)
+        self.h.write("/* AUTOGENERATED, DO NOT EDIT" + self.nl)
         self.h.write(" * Created by libbottle generate.py, ")
         self.h.write(str(datetime.date.today()))
-        self.h.write(nl + " */ " + nl + nl)
+        self.h.write(self.nl + " */ " + self.nl + self.nl)
         inc_guard = "BOTTLE_" + name.upper() + "_HEAD"
-        self.h.write("#ifndef " + inc_guard + nl)
-        self.h.write("#define " + inc_guard + nl)
-        self.h.write(nl + "#include <stdio.h>" + nl)
-        self.h.write(nl + "#ifdef __cplusplus" + nl)
-        self.h.write('extern "C" {' + nl)
-        self.h.write("#endif" + nl)
-        self.h.write(nl)
-        self.h.write("#ifndef BOTTLE_ENUMS" + nl)
-        self.h.write("#define BOTTLE_ENUMS" + nl)
-        self.h.write("#define BOTTLE_OK 0" + nl)
-        self.h.write("#define BOTTLE_FAIL 1" + nl)
-        self.h.write(nl)
-        self.h.write("struct BottleString { char *str; unsigned len; }; ")
-        self.h.write(nl)
-        self.h.write("#endif" + nl + nl)
+        self.h.write("#ifndef " + inc_guard + self.nl)
+        self.h.write("#define " + inc_guard + self.nl)
+        self.h.write(self.nl + "#include <stdio.h>" + self.nl)
+        self.h.write("#include <stdint.h>" + self.nl)
+        self.h.write(self.nl + "#ifdef __cplusplus" + self.nl)
+        self.h.write('extern "C" {' + self.nl)
+        self.h.write("#endif" + self.nl)
+        self.h.write(self.nl)
+        self.h.write("#ifndef BOTTLE_ENUMS" + self.nl)
+        self.h.write("#define BOTTLE_ENUMS" + self.nl)
+        self.h.write("#define BOTTLE_OK 0" + self.nl)
+        self.h.write("#define BOTTLE_FAIL 1" + self.nl)
+        self.h.write(self.nl)
+        self.h.write("struct BottleString { char *str; unsigned len; unsigned cap; }; ")
+        self.h.write(self.nl)
+        for t in sorted(C_TYPES.keys()):
+            self.h.write("struct Bottle" + capitalize(t) + "Array { " + C_TYPES[t] + " *data; unsigned len; unsigned cap; };" + self.nl)
+        self.h.write("#endif" + self.nl)
+        self.h.write(c_writer_decls)
     
     def close(self):
-        self.h.write(nl + "#ifdef __cplusplus" + nl)
-        self.h.write('}' + nl)
-        self.h.write("#endif" + nl)
-        self.h.write(nl + "#endif" + nl)
+        self.h.write(self.nl + "#ifdef __cplusplus" + self.nl)
+        self.h.write('}' + self.nl)
+        self.h.write("#endif" + self.nl)
+        self.h.write(self.nl + "#endif" + self.nl)
         
         self.c.close()
         self.h.close()
     
-    def writeMemReaderChildren(self, children, tabs, parents):
-        pass
+    def member(self, var):
+        return var["name"]
+
+    # Each distinct block body gets one named struct and one set of static
+    # read/write functions, shared by every place that body appears.
+    def shapeFor(self, key, block):
+        shape_key = block["shape"]
+        if shape_key in self.shapes:
+            return self.shapes[shape_key]
+        struct_name = "BottleChild" + capitalize(key)
+        fn_name = "child_" + key
+        n = 1
+        while struct_name in self.struct_names:
+            n += 1
+            struct_name = "BottleChild" + capitalize(key) + str(n)
+            fn_name = "child_" + key + "_" + str(n)
+        shape = (struct_name, fn_name)
+        self.struct_names.append(struct_name)
+        self.shapes[shape_key] = shape
+        self.writeShape(struct_name, fn_name, block, False)
+        return shape
+
+    def childShapes(self, children):
+        shapes = {}
+        for variant in self.childVariants(children):
+            shapes[variant["name"]] = self.shapeFor(variant["name"], variant["block"])
+        return shapes
+
+    # Variants with an empty body have no struct or functions of their own.
+    def childVariants(self, children):
+        return [variant for variant in children["variants"] if not variant["block"]["empty"]]
+
+    def childKeys(self, children):
+        return [variant["name"] for variant in self.childVariants(children)]
 
-    def writeFileReaderChildren(self, children, tabs, parents):
+    # Returns the C expression for a pointer to the child struct of a variant.
+    def childPointer(self, base, children, key):
+        member = base + "->" + capitalize(children["enum"]) + "Data." + key
+        if key in self.out_of_line:
+            return member
+        return "&(" + member + ")"
+
+    def writeArrayAlloc(self, member, c_type, reload):
+        tab = self.tab
+        nl = self.nl
+        if reload:
+            self.c.write(tab + "if(" + member + ".cap < " + member + ".len){" + nl)
+            self.c.write(tab + tab + c_type + " *const data = (" + c_type + "*)realloc(" + member + ".data, " + member + ".len * sizeof(" + c_type + "));" + nl)
+            self.c.write(tab + tab + "if(data == NULL){ " + member + ".len = 0; return BOTTLE_FAIL; }" + nl)
+            self.c.write(tab + tab + member + ".data = data;" + nl)
+            self.c.write(tab + tab + member + ".cap = " + member + ".len;" + nl)
+            self.c.write(tab + "}" + nl)
+        else:
+            self.c.write(tab + member + ".data = (" + c_type + "*)malloc(" + member + ".len * sizeof(" + c_type + "));" + nl)
+            self.c.write(tab + "if(" + member + ".len != 0 && " + member + ".data == NULL) return BOTTLE_FAIL;" + nl)
+            self.c.write(tab + member + ".cap = " + member + ".len;" + nl)
+
+    # Sets the children tag from the local tag. When reloading, a change of
+    # variant frees the old one first, since it shares memory with the new one.
+    def writeTagStore(self, fn_name, children, reload, tabs):
+        tabn = self.calcTabs(tabs)
         enum_name_u = capitalize(children["enum"])
-        tabn = calcTabs(tabs)
-        self.c.write(tabn + "out->")
-        for p in parents:
-            self.c.write(p + ".")
-        self.c.write(enum_name_u + " = fgetc(from); " + nl)
-        self.c.write(tabn + "switch(out->")
-        for p in parents:
-            self.c.write(p + ".")
-        self.c.write(enum_name_u + "){" + nl)
-        keys = children.keys()
-        keys.sort()
-        for key in keys:
-            if key == "enum":
-                continue
-            self.c.write(tabn + "if(feof(from) != 0) return BOTTLE_FAIL;" + nl)
-            self.c.write(tabn + tab + "case e" + capitalize(key) + ":" + nl)
-            self.writeFileReader(key, children[key], tabs + 2, parents + [enum_name_u + "Data", key])
-            self.c.write(tabn + tab + "break;" + nl)
-        self.c.write(tabn + "}" + nl)
+        if reload:
+            self.c.write(tabn + "if(out->" + enum_name_u + " != (enum EnumBottle" + enum_name_u + ")tag){" + self.nl)
+            self.c.write(tabn + self.tab + "bottle_free_" + fn_name + "_children(out);" + self.nl)
+            self.c.write(tabn + self.tab + "memset(&(out->" + enum_name_u + "Data), 0, sizeof(out->" + enum_name_u + "Data));" + self.nl)
+            self.c.write(tabn + self.tab + "out->" + enum_name_u + " = tag;" + self.nl)
+            self.c.write(tabn + "}" + self.nl)
+        else:
+            self.c.write(tabn + "out->" + enum_name_u + " = tag;" + self.nl)
 
-    def writeMemReader(self, block_name, block, tabs = 1, parents = []):
-        cap_name = capitalize(block_name)
+    def writeChildAlloc(self, children, key, child_name, reload):
+        tabn = self.tab
+        member = "out->" + capitalize(children["enum"]) + "Data." + key
+        if reload:
+            self.c.write(tabn + "if(" + member + " == NULL)" + self.nl)
+            self.c.write(tabn + self.tab + member + " = calloc(1, sizeof(struct " + child_name + "));" + self.nl)
+        else:
+            self.c.write(tabn + member + " = malloc(sizeof(struct " + child_name + "));" + self.nl)
+        self.c.write(tabn + "if(" + member + " == NULL) return BOTTLE_FAIL;" + self.nl)
 
-    def writeFileReader(self, block_name, block, tabs = 1, parents = []):
-        cap_name = capitalize(block_name)
-        tabn = calcTabs(tabs)
-        keys = block.keys()
-        keys.sort()
-        for key in keys:
-            if key == "children":
+    # With reload set, writes bottle_reload_* functions that reuse the string,
+    # array and out of line buffers already in the struct. With fields set,
+    # writes a bottle_project_* function that only reads the named fields and
+    # skips over the rest.
+    def writeFileReader(self, struct_name, fn_name, block, shapes, reload = False, fields = None):
+        tab = self.tab
+        nl = self.nl
+        if reload:
+            prefix = "bottle_reload_"
+        else:
+            prefix = "bottle_read_"
+        if fields == None:
+            self.c.write("static unsigned " + prefix + fn_name + "_file(struct " + struct_name + " *out, FILE *from){" + nl)
+        else:
+            self.c.write("static unsigned bottle_project_" + fn_name + "_file(struct " + struct_name + " *out, FILE *from){" + nl)
+        skip = 0
+        for var in block["fields"]:
+            if fields != None and not (var["name"] in fields):
+                skip = self.writeFieldSkip(var, True, skip)
                 continue
-            self.c.write(tabn + "if(feof(from) != 0) return BOTTLE_FAIL;" + nl)
-            var = self.getVariable(key, block[key])
+            self.writeSkipRun(skip, True)
+            skip = 0
+            self.c.write(tab + "if(feof(from) != 0) return BOTTLE_FAIL;" + nl)
+            member = "out->" + self.member(var)
             if var["type"] == "string":
-                self.c.write(tabn + "bottle_read_string_file(from, &(out->")
-                for p in parents:
-                    self.c.write(p + ".")
-                self.c.write(var["name"] + "));" + nl)
-            elif var["type"] in self.enums:
-                self.c.write(tabn + "{ unsigned i; fread(&i, 1, 4, from);" + nl)
-                self.c.write(tabn + tab + "out->")
-                for p in parents:
-                    self.c.write(p + ".")
-                self.c.write(var["name"] + " = i; }" + nl)
+                self.c.write(tab + "if(" + prefix + "string_file(from, &(" + member + ")) != BOTTLE_OK) return BOTTLE_FAIL;" + nl)
+            elif "array" in var["attr"]:
+                c_type = C_TYPES[var["type"]]
+                self.c.write(tab + "if(fread(&(" + member + ".len), 1, 4, from) != 4) return BOTTLE_FAIL;" + nl)
+                self.writeArrayAlloc(member, c_type, reload)
+                self.c.write(tab + "if(" + member + ".len != 0 && fread(" + member + ".data, sizeof(" + c_type + "), " + member + ".len, from) != " + member + ".len) return BOTTLE_FAIL;" + nl)
+            elif var["kind"] == "enum":
+                self.c.write(tab + "{ unsigned i; fread(&i, 1, 4, from);" + nl)
+                self.c.write(tab + tab + member + " = i; }" + nl)
             else:
-                self.c.write(tabn + "fread(&(out->")
-                for p in parents:
-                    self.c.write(p + ".")
-                self.c.write(var["name"] + "), 1, 4, from);" + nl)
-        if "children" in block:
-            self.c.write(tabn + "{" + nl)
-            self.writeFileReaderChildren(block["children"], tabs + 1, parents)
-            self.c.write(tabn + "}" + nl)
-
-    def writeMemWriterChildren(self, children, tabs, parents):
-        pass
+                self.c.write(tab + "fread(&(" + member + "), 1, " + str(var["size"]) + ", from);" + nl)
+        self.writeSkipRun(skip, True)
+        if block["children"] != None and fields != None and not ("children" in fields):
+            self.writeChildrenSkip(block["children"], shapes, True)
+        elif block["children"] != None:
+            children = block["children"]
+            enum_name_u = capitalize(children["enum"])
+            self.c.write(tab + "{" + nl)
+            self.c.write(tab + tab + "const int tag = fgetc(from);" + nl)
+            self.c.write(tab + tab + "if(tag < 0 || tag >= NUM_" + enum_name_u + ") return BOTTLE_FAIL;" + nl)
+            self.writeTagStore(fn_name, children, reload, 2)
+            self.c.write(tab + "}" + nl)
+            self.writeVariantCall(fn_name, children, "out", prefix[len("bottle_"):] + "file", "from", 1, "return ")
+        elif len(block["fields"]) == 0:
+            self.c.write(tab + "(void)out;" + nl + tab + "(void)from;" + nl)
+        self.c.write(tab + "return BOTTLE_OK;" + nl + "}" + nl + nl)
 
-    def writeFileWriterChildren(self, children, tabs, parents):
-        enum_name_u = capitalize(children["enum"])
-        tabn = calcTabs(tabs)
-        self.c.write(tabn + "fputc(from->")
-        for p in parents:
-            self.c.write(p + ".")
-        self.c.write(enum_name_u + ", to); " + nl)
-        self.c.write(tabn + "switch(from->")
-        for p in parents:
-            self.c.write(p + ".")
-        self.c.write(enum_name_u + "){" + nl)
-        keys = children.keys()
-        keys.sort()
-        for key in keys:
-            if key == "enum":
+    def writeMemReader(self, struct_name, fn_name, block, shapes, reload = False, fields = None):
+        tab = self.tab
+        nl = self.nl
+        if reload:
+            prefix = "bottle_reload_"
+        else:
+            prefix = "bottle_read_"
+        if fields == None:
+            self.c.write("static unsigned " + prefix + fn_name + "_mem(struct " + struct_name + " *out," + nl)
+        else:
+            self.c.write("static unsigned bottle_project_" + fn_name + "_mem(struct " + struct_name + " *out," + nl)
+        self.c.write(tab + "const unsigned char *mem, unsigned len, unsigned *at){" + nl)
+        skip = 0
+        for var in block["fields"]:
+            if fields != None and not (var["name"] in fields):
+                skip = self.writeFieldSkip(var, False, skip)
                 continue
-            self.c.write(tabn + tab + "case e" + capitalize(key) + ":" + nl)
-            self.writeFileWriter(key, children[key], tabs + 2, parents + [enum_name_u + "Data", key])
-            self.c.write(tabn + tab + "break;" + nl)
-        self.c.write(tabn + "}" + nl)
+            self.writeSkipRun(skip, False)
+            skip = 0
+            member = "out->" + self.member(var)
+            if var["type"] == "string":
+                self.c.write(tab + "if(" + prefix + "string_mem(mem, len, at, &(" + member + ")) != BOTTLE_OK) return BOTTLE_FAIL;" + nl)
+                continue
+            size = var["size"]
+            if "array" in var["attr"]:
+                c_type = C_TYPES[var["type"]]
+                self.c.write(tab + "if(len < at[0] + 4) return BOTTLE_FAIL;" + nl)
+                self.c.write(tab + "memcpy(&(" + member + ".len), mem + at[0], 4);" + nl)
+                self.c.write(tab + "at[0] += 4;" + nl)
+                self.c.write(tab + "if((len - at[0]) / sizeof(" + c_type + ") < " + member + ".len) return BOTTLE_FAIL;" + nl)
+                self.writeArrayAlloc(member, c_type, reload)
+                self.c.write(tab + "if(" + member + ".len != 0) memcpy(" + member + ".data, mem + at[0], " + member + ".len * sizeof(" + c_type + "));" + nl)
+                self.c.write(tab + "at[0] += " + member + ".len * sizeof(" + c_type + ");" + nl)
+                continue
+            self.c.write(tab + "if(len < at[0] + " + str(size) + ") return BOTTLE_FAIL;" + nl)
+            if var["kind"] == "enum":
+                self.c.write(tab + "{ unsigned i; memcpy(&i, mem + at[0], 4);" + nl)
+                self.c.write(tab + tab + member + " = i; }" + nl)
+            else:
+                self.c.write(tab + "memcpy(&(" + member + "), mem + at[0], " + str(size) + ");" + nl)
+            self.c.write(tab + "at[0] += " + str(size) + ";" + nl)
+        self.writeSkipRun(skip, False)
+        if block["children"] != None and fields != None and not ("children" in fields):
+            self.writeChildrenSkip(block["children"], shapes, False)
+        elif block["children"] != None:
+            children = block["children"]
+            enum_name_u = capitalize(children["enum"])
+            self.c.write(tab + "if(len < at[0] + 1 || mem[at[0]] >= NUM_" + enum_name_u + ") return BOTTLE_FAIL;" + nl)
+            self.c.write(tab + "{" + nl)
+            self.c.write(tab + tab + "const unsigned tag = mem[at[0]++];" + nl)
+            self.writeTagStore(fn_name, children, reload, 2)
+            self.c.write(tab + "}" + nl)
+            self.writeVariantCall(fn_name, children, "out", prefix[len("bottle_"):] + "mem", "mem, len, at", 1, "return ")
+        elif len(block["fields"]) == 0:
+            for name in ("out", "mem", "len", "at"):
+                self.c.write(tab + "(void)" + name + ";" + nl)
+        self.c.write(tab + "return BOTTLE_OK;" + nl + "}" + nl + nl)
 
-    def writeMemWriter(self, block_name, block, tabs = 1, parents = []):
-        cap_name = capitalize(block_name)
+    # Skips a run of fixed-size fields in a single seek or bounds check.
+    def writeSkipRun(self, skip, file):
+        if skip == 0:
+            return
+        if file:
+            self.c.write(self.tab + "if(bottle_skip_file(from, " + str(skip) + ") != BOTTLE_OK) return BOTTLE_FAIL;" + self.nl)
+        else:
+            self.c.write(self.tab + "if(len < at[0] + " + str(skip) + ") return BOTTLE_FAIL;" + self.nl)
+            self.c.write(self.tab + "at[0] += " + str(skip) + ";" + self.nl)
 
-    def writeFileWriter(self, block_name, block, tabs = 1, parents = []):
-        cap_name = capitalize(block_name)
-        tabn = calcTabs(tabs)
-        keys = block.keys()
-        keys.sort()
+    # Skips over a field without storing it. Fixed-size fields are only added
+    # to the pending run, which is returned. Strings and arrays are skipped
+    # using their length prefix.
+    def writeFieldSkip(self, var, file, skip):
+        tab = self.tab
+        nl = self.nl
+        if var["type"] != "string" and not ("array" in var["attr"]):
+            return skip + var["size"]
+        self.writeSkipRun(skip, file)
+        size = str(var["size"])
+        if file and var["type"] == "string":
+            self.c.write(tab + "{ const int n = fgetc(from);" + nl)
+            self.c.write(tab + tab + "if(n == EOF || bottle_skip_file(from, n) != BOTTLE_OK) return BOTTLE_FAIL; }" + nl)
+        elif file:
+            self.c.write(tab + "{ unsigned n;" + nl)
+            self.c.write(tab + tab + "if(fread(&n, 1, 4, from) != 4 || bottle_skip_file(from, (unsigned long)n * " + size + ") != BOTTLE_OK) return BOTTLE_FAIL; }" + nl)
+        elif var["type"] == "string":
+            self.c.write(tab + "if(len < at[0] + 1 || len - at[0] - 1 < mem[at[0]]) return BOTTLE_FAIL;" + nl)
+            self.c.write(tab + "at[0] += 1 + mem[at[0]];" + nl)
+        else:
+            self.c.write(tab + "{ unsigned n;" + nl)
+            self.c.write(tab + tab + "if(len < at[0] + 4) return BOTTLE_FAIL;" + nl)
+            self.c.write(tab + tab + "memcpy(&n, mem + at[0], 4);" + nl)
+            self.c.write(tab + tab + "at[0] += 4;" + nl)
+            self.c.write(tab + tab + "if((len - at[0]) / " + size + " < n) return BOTTLE_FAIL;" + nl)
+            self.c.write(tab + tab + "at[0] += n * " + size + "; }" + nl)
+        return 0
+
+    def writeChildrenSkip(self, children, shapes, file):
+        tab = self.tab
+        nl = self.nl
+        enum_name_u = capitalize(children["enum"])
+        if file:
+            self.c.write(tab + "{ const int tag = fgetc(from);" + nl)
+            self.c.write(tab + tab + "if(tag < 0 || tag >= NUM_" + enum_name_u + ") return BOTTLE_FAIL;" + nl)
+            args = "(from)"
+            suffix = "_file"
+        else:
+            self.c.write(tab + "{ unsigned tag;" + nl)
+            self.c.write(tab + tab + "if(len < at[0] + 1 || mem[at[0]] >= NUM_" + enum_name_u + ") return BOTTLE_FAIL;" + nl)
+            self.c.write(tab + tab + "tag = mem[at[0]++];" + nl)
+            args = "(mem, len, at)"
+            suffix = "_mem"
+        keys = self.childKeys(children)
+        if len(keys) == 0:
+            self.c.write(tab + tab + "(void)tag; }" + nl)
+            return
+        self.c.write(tab + tab + "switch(tag){" + nl)
         for key in keys:
-            if key == "children":
+            self.c.write(tab + tab + tab + "case e" + capitalize(key) + ": return bottle_skip_" + shapes[key][1] + suffix + args + ";" + nl)
+        self.c.write(tab + tab + tab + "default: break;" + nl)
+        self.c.write(tab + tab + "}" + nl)
+        self.c.write(tab + "}" + nl)
+
+    # Whether skipping a block has to look at its contents, rather than just
+    # stepping over a constant number of bytes.
+    def readsMem(self, block):
+        if block["children"] != None:
+            return True
+        for var in block["fields"]:
+            if var["kind"] == "string" or var["kind"] == "array":
+                return True
+        return False
+
+    # bottle_skip_* functions step over a whole encoded block without storing
+    # anything, for children left out of a projection. Written on demand, once
+    # per shape, after the skippers of its own children.
+    def writeSkipper(self, fn_name, block):
+        if fn_name in self.skippers:
+            return
+        self.skippers.append(fn_name)
+        shapes = {}
+        if block["children"] != None:
+            children = block["children"]
+            shapes = self.childShapes(children)
+            for variant in self.childVariants(children):
+                self.writeSkipper(shapes[variant["name"]][1], variant["block"])
+        if not self.wrote_skip_file:
+            self.c.write(c_skip_file)
+            self.wrote_skip_file = True
+        for file in (True, False):
+            if file:
+                self.c.write("static unsigned bottle_skip_" + fn_name + "_file(FILE *from){" + self.nl)
+            else:
+                self.c.write("static unsigned bottle_skip_" + fn_name + "_mem(const unsigned char *mem, unsigned len, unsigned *at){" + self.nl)
+                if not self.readsMem(block):
+                    self.c.write(self.tab + "(void)mem;" + self.nl)
+            skip = 0
+            for var in block["fields"]:
+                skip = self.writeFieldSkip(var, file, skip)
+            self.writeSkipRun(skip, file)
+            if block["children"] != None:
+                self.writeChildrenSkip(block["children"], shapes, file)
+            self.c.write(self.tab + "return BOTTLE_OK;" + self.nl + "}" + self.nl + self.nl)
+
+    # Frees everything owned by the struct, leaving it zeroed so it can be
+    # freed again or reloaded.
+    def writeFree(self, struct_name, fn_name, block, shapes):
+        tab = self.tab
+        nl = self.nl
+        if block["children"] != None:
+            children = block["children"]
+            enum_name_u = capitalize(children["enum"])
+            self.c.write("static void bottle_free_" + fn_name + "_children(struct " + struct_name + " *b){" + nl)
+            self.c.write(tab + "switch(b->" + enum_name_u + "){" + nl)
+            for key in self.childKeys(children):
+                child_fn = shapes[key][1]
+                self.c.write(tab + tab + "case e" + capitalize(key) + ":" + nl)
+                if key in self.out_of_line:
+                    member = "b->" + enum_name_u + "Data." + key
+                    self.c.write(tab + tab + tab + "if(" + member + " != NULL){" + nl)
+                    self.c.write(tab + tab + tab + tab + "bottle_free_" + child_fn + "(" + member + ");" + nl)
+                    self.c.write(tab + tab + tab + tab + "free(" + member + ");" + nl)
+                    self.c.write(tab + tab + tab + tab + member + " = NULL;" + nl)
+                    self.c.write(tab + tab + tab + "}" + nl)
+                else:
+                    self.c.write(tab + tab + tab + "bottle_free_" + child_fn + "(" + self.childPointer("b", children, key) + ");" + nl)
+                self.c.write(tab + tab + tab + "break;" + nl)
+            self.c.write(tab + tab + "default: break;" + nl)
+            self.c.write(tab + "}" + nl)
+            self.c.write("}" + nl + nl)
+
+        self.c.write("static void bottle_free_" + fn_name + "(struct " + struct_name + " *b){" + nl)
+        owned = False
+        for var in block["fields"]:
+            member = "b->" + self.member(var)
+            if var["type"] == "string":
+                self.c.write(tab + "free(" + member + ".str);" + nl)
+                self.c.write(tab + member + ".str = NULL;" + nl)
+            elif "array" in var["attr"]:
+                self.c.write(tab + "free(" + member + ".data);" + nl)
+                self.c.write(tab + member + ".data = NULL;" + nl)
+            else:
                 continue
-            var = self.getVariable(key, block[key])
+            self.c.write(tab + member + ".len = " + member + ".cap = 0;" + nl)
+            owned = True
+        if block["children"] != None:
+            self.c.write(tab + "bottle_free_" + fn_name + "_children(b);" + nl)
+        elif not owned:
+            self.c.write(tab + "(void)b;" + nl)
+        self.c.write("}" + nl + nl)
+
+
+    def writeFileWriter(self, struct_name, fn_name, block):
+        tab = self.tab
+        nl = self.nl
+        self.c.write("static void bottle_write_" + fn_name + "_file(const struct " + struct_name + " *from, FILE *to){" + nl)
+        for var in block["fields"]:
+            member = "from->" + self.member(var)
+            if var["type"] == "string":
+                self.c.write(tab + "bottle_write_string_file(to, &(" + member + "));" + nl)
+            elif "array" in var["attr"]:
+                self.c.write(tab + "fwrite(&(" + member + ".len), 1, 4, to);" + nl)
+                self.c.write(tab + "if(" + member + ".len != 0) fwrite(" + member + ".data, sizeof(" + C_TYPES[var["type"]] + "), " + member + ".len, to);" + nl)
+            elif var["kind"] == "enum":
+                self.c.write(tab + "{ const unsigned i = " + member + "; fwrite(&i, 1, 4, to); }" + nl)
+            else:
+                self.c.write(tab + "fwrite(&(" + member + "), 1, " + str(var["size"]) + ", to);" + nl)
+        if block["children"] != None:
+            children = block["children"]
+            enum_name_u = capitalize(children["enum"])
+            self.c.write(tab + "fputc(from->" + enum_name_u + ", to);" + nl)
+            self.writeVariantCall(fn_name, children, "from", "write_file", "to")
+        elif len(block["fields"]) == 0:
+            self.c.write(tab + "(void)from;" + nl + tab + "(void)to;" + nl)
+        self.c.write("}" + nl + nl)
+
+    # Size of the encoded block, so the mem writer can allocate once.
+    def writeSizer(self, struct_name, fn_name, block):
+        tab = self.tab
+        nl = self.nl
+        self.c.write("static unsigned bottle_size_" + fn_name + "(const struct " + struct_name + " *from){" + nl)
+        size = 0
+        strings = []
+        for var in block["fields"]:
             if var["type"] == "string":
-                self.c.write(tabn + "bottle_write_string_file(to, &(from->")
-                for p in parents:
-                    self.c.write(p + ".")
-                self.c.write(var["name"] + "));" + nl)
-            elif var["type"] in self.enums:
-                self.c.write(tabn + "{ const unsigned i = from->")
-                for p in parents:
-                    self.c.write(p + ".")
-                self.c.write(var["name"] + "; fwrite(&i, 1, 4, to); };" + nl)
+                size += 1
+                strings.append("from->" + self.member(var) + ".len")
+            elif "array" in var["attr"]:
+                size += 4
+                strings.append("from->" + self.member(var) + ".len * " + str(var["size"]))
+            else:
+                size += var["size"]
+        if block["children"] != None:
+            size += 1
+        self.c.write(tab + "unsigned size = " + " + ".join([str(size)] + strings) + ";" + nl)
+        if block["children"] == None and len(strings) == 0:
+            self.c.write(tab + "(void)from;" + nl)
+        if block["children"] != None:
+            children = block["children"]
+            enum_name_u = capitalize(children["enum"])
+            self.c.write(tab + "if((unsigned)from->" + enum_name_u + " < NUM_" + enum_name_u + "){" + nl)
+            self.c.write(tab + tab + "const struct bottle_" + fn_name + "_variant *const v = bottle_" + fn_name + "_variants + from->" + enum_name_u + ";" + nl)
+            self.c.write(tab + tab + "size += v->size_of != NULL ? v->size_of(from) : v->size;" + nl)
+            self.c.write(tab + "}" + nl)
+        self.c.write(tab + "return size;" + nl + "}" + nl + nl)
+
+    # Children of a fixed size don't get a size function, since their size is
+    # in the parent's variant table.
+    def writeMemWriter(self, struct_name, fn_name, block, sized = True):
+        tab = self.tab
+        nl = self.nl
+        if sized:
+            self.writeSizer(struct_name, fn_name, block)
+        self.c.write("static void bottle_write_" + fn_name + "_mem(const struct " + struct_name + " *from," + nl)
+        self.c.write(tab + "unsigned char *to, unsigned *at){" + nl)
+        for var in block["fields"]:
+            member = "from->" + self.member(var)
+            if var["type"] == "string":
+                self.c.write(tab + "bottle_write_string_mem(to, at, &(" + member + "));" + nl)
+                continue
+            elif "array" in var["attr"]:
+                c_type = C_TYPES[var["type"]]
+                self.c.write(tab + "memcpy(to + at[0], &(" + member + ".len), 4);" + nl)
+                self.c.write(tab + "at[0] += 4;" + nl)
+                self.c.write(tab + "if(" + member + ".len != 0) memcpy(to + at[0], " + member + ".data, " + member + ".len * sizeof(" + c_type + "));" + nl)
+                self.c.write(tab + "at[0] += " + member + ".len * sizeof(" + c_type + ");" + nl)
+                continue
+            elif var["kind"] == "enum":
+                self.c.write(tab + "{ const unsigned i = " + member + "; memcpy(to + at[0], &i, 4); }" + nl)
             else:
-                self.c.write(tabn + "fwrite(&(from->")
-                for p in parents:
-                    self.c.write(p + ".")
-                self.c.write(var["name"] + "), 1, 4, to);" + nl)
-        if "children" in block:
-            self.c.write(tabn + "{" + nl)
-            self.writeFileWriterChildren(block["children"], tabs + 1, parents)
-            self.c.write(tabn + "}" + nl)
+                self.c.write(tab + "memcpy(to + at[0], &(" + member + "), " + str(var["size"]) + ");" + nl)
+            self.c.write(tab + "at[0] += " + str(var["size"]) + ";" + nl)
+        if block["children"] != None:
+            children = block["children"]
+            enum_name_u = capitalize(children["enum"])
+            self.c.write(tab + "to[at[0]++] = from->" + enum_name_u + ";" + nl)
+            self.writeVariantCall(fn_name, children, "from", "write_mem", "to, at")
+        elif len(block["fields"]) == 0:
+            for name in ("from", "to", "at"):
+                self.c.write(tab + "(void)" + name + ";" + nl)
+        self.c.write("}" + nl + nl)
     
-    def writeEnum(self, enum_name_l, enumeration):
-        l = len(enumeration)
+    def writeEnum(self, enum):
+        enum_name_l = enum["name"]
         enum_name = "EnumBottle" + capitalize(enum_name_l)
         self.enums.append(enum_name_l)
-        if l == 0:
-            self.h.write("typedef unsigned " + enum_name + ";" + nl)
+        self.enum_defs[enum_name_l] = enum["values"]
+        if len(enum["values"]) == 0:
+            self.h.write("typedef unsigned " + enum_name + ";" + self.nl)
         else:
-            self.h.write("enum " + enum_name + "{" + nl)
-            values = sorted(enumeration)
-            for e in values:
-                self.h.write(tab + "e" + capitalize(str(e)) +"," + nl)
-            self.h.write(tab + "NUM_" + capitalize(enum_name_l) + nl + "};" + nl)
+            self.h.write("enum " + enum_name + "{" + self.nl)
+            for e in enum["values"]:
+                self.h.write(self.tab + "e" + capitalize(str(e)) +"," + self.nl)
+            self.h.write(self.tab + "NUM_" + capitalize(enum_name_l) + self.nl + "};" + self.nl)
     
-    def writeChildren(self, children, tabs):
-        tabn0 = calcTabs(tabs - 1)
-        tabn = tabn0 + tab
+    # Alignment and size of each member on an LP64 target, used to order
+    # struct members. This only affects the in-memory layout, the wire order
+    # is still decided by the readers and writers.
+    def memberLayout(self, var):
+        if var["type"] == "string" or "array" in var["attr"]:
+            return (8, 16)
+        size = var["size"]
+        return (size, size)
+
+    def childrenLayout(self, children):
+        align = 1
+        size = 0
+        for variant in self.childVariants(children):
+            if variant["name"] in self.out_of_line:
+                a, s = 8, 8
+            else:
+                a, s = self.blockLayout(variant["block"])
+            align = max(align, a)
+            size = max(size, s)
+        return (align, size)
+
+    def blockMembers(self, block):
+        members = []
+        for var in block["fields"]:
+            align, size = self.memberLayout(var)
+            members.append((align, size, var))
+        if block["children"] != None:
+            members.append((4, 4, "enum"))
+            align, size = self.childrenLayout(block["children"])
+            members.append((align, size, "children"))
+        # Stable, so members of the same alignment keep their wire order.
+        members.sort(key = lambda m: -m[0])
+        return members
+
+    def blockLayout(self, block):
+        align = 1
+        size = 0
+        for a, s, member in self.blockMembers(block):
+            size = (size + a - 1) // a * a + s
+            align = max(align, a)
+        return (align, (size + align - 1) // align * align)
+
+    def writeChildren(self, children, shapes):
+        tab = self.tab
+        nl = self.nl
         enum_name_u = capitalize(children["enum"])
-        enum_name = "EnumBottle" + enum_name_u
-        self.h.write(tabn0 + "enum " + enum_name + " " + enum_name_u + ";" + nl)
-        self.h.write(tabn0 + "union{" + nl)
-        keys = children.keys()
-        keys.sort()
-        for key in keys:
-            if key == "enum":
-                continue
-            child = children[key]
-            if len(child) == 0:
-                self.h.write(tabn + "/* No members for " + key + "*/" + nl)
+        self.h.write(tab + "union{" + nl)
+        for variant in children["variants"]:
+            key = variant["name"]
+            if variant["block"]["empty"]:
+                self.h.write(tab + tab + "/* No members for " + key + "*/" + nl)
+            elif key in self.out_of_line:
+                self.h.write(tab + tab + "struct " + shapes[key][0] + " *" + key + ";" + nl)
             else:
-                self.h.write(tabn + "struct {" + nl)
-                self.writeBlock(key, child, tabs + 1, False)
-                self.h.write(tabn + "} " + key + ";" + nl)
-            
-        
-        self.h.write(tabn0 + "}" + enum_name_u + "Data;" + nl)
+                self.h.write(tab + tab + "struct " + shapes[key][0] + " " + key + ";" + nl)
+        self.h.write(tab + "}" + enum_name_u + "Data;" + nl)
 
-    def writeBlock(self, block_name, block, tabs=1, write_struct = True):
-        tabn0 = calcTabs(tabs - 1)
-        tabn = tabn0 + tab
-        cap_name = capitalize(block_name)
-        if write_struct:
-            mem_reader = "unsigned Bottle_Load" + cap_name + "Mem(struct Bottle" + cap_name + " *out, const void *mem, unsigned len)"
-            file_reader = "unsigned Bottle_Load" + cap_name + "File(struct Bottle" + cap_name + " *out, FILE *from)"
-            
-            mem_writer = "void *Bottle_Write" + cap_name + "Mem(const struct Bottle" + cap_name + "* from, unsigned *size_out)"
-            file_writer = "void Bottle_Write" + cap_name + "File(const struct Bottle" + cap_name + "* from, FILE *to)"
-            
-            self.h.write(tabn0)
-            self.h.write("struct Bottle" + cap_name + ";" + nl)
-            self.h.write(nl)
-            self.h.write(mem_reader + ";" + nl)
-            self.h.write(file_reader + ";" + nl)
-            self.h.write(mem_writer + ";" + nl)
-            self.h.write(file_writer + ";" + nl)
-
-            self.c.write(mem_writer  +"{" + nl)
-            self.writeMemWriter(block_name, block)
-            self.c.write("}" + nl)
-
-            self.c.write(file_writer  +"{" + nl)
-            self.writeFileWriter(block_name, block)
-            self.c.write("}" + nl)
-
-            self.c.write(mem_reader  +"{" + nl)
-            self.writeMemReader(block_name, block)
-            self.c.write(tab + "return BOTTLE_OK;" + nl + "}" + nl)
-
-            self.c.write(file_reader  +"{" + nl)
-            self.writeFileReader(block_name, block)
-            self.c.write(tab + "return BOTTLE_OK;" + nl + "}" + nl)
-
-            self.h.write("struct Bottle" + cap_name + " { " + nl)
-
-        keys = children.keys()
-        keys.sort()
-        for key in keys:
-            if key == "children":
+    def writeStruct(self, struct_name, block, shapes):
+        tab = self.tab
+        nl = self.nl
+        self.h.write("struct " + struct_name + " { " + nl)
+        for align, size, member in self.blockMembers(block):
+            if member == "children":
+                self.writeChildren(block["children"], shapes)
+                continue
+            self.h.write(tab)
+            if member == "enum":
+                enum_name_u = capitalize(block["children"]["enum"])
+                self.h.write("enum EnumBottle" + enum_name_u + " " + enum_name_u + ";" + nl)
                 continue
-            var = self.getVariable(key, block[key])
-            self.h.write(tabn)
+            var = member
             if var["type"] == "string":
                 self.h.write("struct BottleString ")
-            if var["type"] in self.enums:
+            elif "array" in var["attr"]:
+                self.h.write("struct Bottle" + capitalize(var["type"]) + "Array ")
+            elif var["kind"] == "enum":
                 self.h.write("enum EnumBottle" + capitalize(var["type"]) + ' ')
             else:
-                self.h.write(var["type"] + ' ')
-            self.h.write(var["name"] + ";" + nl)
+                self.h.write(C_TYPES[var["type"]] + ' ')
+            self.h.write(self.member(var) + ";" + nl)
+        self.h.write("};" + nl + nl)
+
+    # The children of a block are decoded and encoded through a table indexed
+    # by tag, holding the encoded size of each variant and functions that read
+    # or write it given the parent struct. Values without a child have no
+    # functions, and a size of 0.
+    def writeVariantTable(self, struct_name, fn_name, block, shapes):
+        tab = self.tab
+        nl = self.nl
+        children = block["children"]
+        entry = "bottle_" + fn_name + "_variant"
+        parent = "struct " + struct_name + " *"
+        self.c.write("struct " + entry + " {" + nl)
+        self.c.write(tab + "unsigned size;" + nl)
+        self.c.write(tab + "unsigned (*read_file)(" + parent + "out, FILE *from);" + nl)
+        self.c.write(tab + "unsigned (*read_mem)(" + parent + "out, const unsigned char *mem, unsigned len, unsigned *at);" + nl)
+        self.c.write(tab + "unsigned (*reload_file)(" + parent + "out, FILE *from);" + nl)
+        self.c.write(tab + "unsigned (*reload_mem)(" + parent + "out, const unsigned char *mem, unsigned len, unsigned *at);" + nl)
+        self.c.write(tab + "void (*write_file)(const " + parent + "from, FILE *to);" + nl)
+        self.c.write(tab + "void (*write_mem)(const " + parent + "from, unsigned char *to, unsigned *at);" + nl)
+        self.c.write(tab + "void (*write_writer)(const " + parent + "from, struct BottleWriter *to);" + nl)
+        self.c.write(tab + "/* NULL when size is not BOTTLE_VARIABLE_SIZE */" + nl)
+        self.c.write(tab + "unsigned (*size_of)(const " + parent + "from);" + nl)
+        self.c.write("};" + nl + nl)
+
+        rows = ["{0, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL}"] * len(self.enum_defs[children["enum"]])
+        for variant in self.childVariants(children):
+            key = variant["name"]
+            child_name, child_fn = shapes[key]
+            prefix = "bottle_" + fn_name + "_" + key + "_"
+            for reload in (False, True):
+                if reload:
+                    op = "reload_"
+                else:
+                    op = "read_"
+                self.c.write("static unsigned " + prefix + op + "file(" + parent + "out, FILE *from){" + nl)
+                if key in self.out_of_line:
+                    self.writeChildAlloc(children, key, child_name, reload)
+                self.c.write(tab + "return bottle_" + op + child_fn + "_file(" + self.childPointer("out", children, key) + ", from);" + nl)
+                self.c.write("}" + nl + nl)
+                self.c.write("static unsigned " + prefix + op + "mem(" + parent + "out, const unsigned char *mem, unsigned len, unsigned *at){" + nl)
+                if key in self.out_of_line:
+                    self.writeChildAlloc(children, key, child_name, reload)
+                self.c.write(tab + "return bottle_" + op + child_fn + "_mem(" + self.childPointer("out", children, key) + ", mem, len, at);" + nl)
+                self.c.write("}" + nl + nl)
+            child = self.childPointer("from", children, key)
+            self.c.write("static void " + prefix + "write_file(const " + parent + "from, FILE *to){" + nl)
+            self.c.write(tab + "bottle_write_" + child_fn + "_file(" + child + ", to);" + nl)
+            self.c.write("}" + nl + nl)
+            self.c.write("static void " + prefix + "write_mem(const " + parent + "from, unsigned char *to, unsigned *at){" + nl)
+            self.c.write(tab + "bottle_write_" + child_fn + "_mem(" + child + ", to, at);" + nl)
+            self.c.write("}" + nl + nl)
+            self.c.write("static void " + prefix + "write_writer(const " + parent + "from, struct BottleWriter *to){" + nl)
+            self.c.write(tab + "bottle_write_" + child_fn + "_writer(" + child + ", to);" + nl)
+            self.c.write("}" + nl + nl)
+            if variant["block"]["size"] == None:
+                size = "BOTTLE_VARIABLE_SIZE"
+                size_of = prefix + "size"
+                self.c.write("static unsigned " + prefix + "size(const " + parent + "from){" + nl)
+                self.c.write(tab + "return bottle_size_" + child_fn + "(" + child + ");" + nl)
+                self.c.write("}" + nl + nl)
+            else:
+                size = str(variant["block"]["size"])
+                size_of = "NULL"
+            fns = [prefix + op for op in ("read_file", "read_mem", "reload_file", "reload_mem", "write_file", "write_mem", "write_writer")]
+            rows[variant["tag"]] = "{" + ", ".join([size] + fns + [size_of]) + "}"
+
+        self.c.write("static const struct " + entry + " bottle_" + fn_name + "_variants[NUM_" + capitalize(children["enum"]) + "] = {" + nl)
+        self.c.write(tab + ("," + nl + tab).join(rows) + nl)
+        self.c.write("};" + nl + nl)
+
+    # Writes a call through the variant table for the tag in base, doing
+    # nothing for values without a child. Readers have already checked the
+    # tag, writers check it here so an invalid one writes no child.
+    def writeVariantCall(self, fn_name, children, base, op, args, tabs = 1, ret = ""):
+        tabn = self.calcTabs(tabs)
+        enum_name_u = capitalize(children["enum"])
+        if base == "from":
+            self.c.write(tabn + "if((unsigned)from->" + enum_name_u + " < NUM_" + enum_name_u + "){" + self.nl)
+        else:
+            self.c.write(tabn + "{" + self.nl)
+        self.c.write(tabn + self.tab + "const struct bottle_" + fn_name + "_variant *const v = bottle_" + fn_name + "_variants + " + base + "->" + enum_name_u + ";" + self.nl)
+        self.c.write(tabn + self.tab + "if(v->" + op + " != NULL) " + ret + "v->" + op + "(" + base + ", " + args + ");" + self.nl)
+        self.c.write(tabn + "}" + self.nl)
+
+    # Children are written first, so their structs and functions are defined
+    # before the block that uses them.
+    def writeShape(self, struct_name, fn_name, block, top = True):
+        if block["children"] != None:
+            shapes = self.childShapes(block["children"])
+        else:
+            shapes = {}
+        self.writeStruct(struct_name, block, shapes)
+        self.writeFree(struct_name, fn_name, block, shapes)
+        if block["children"] != None:
+            self.writeVariantTable(struct_name, fn_name, block, shapes)
+        self.writeFileReader(struct_name, fn_name, block, shapes)
+        self.writeMemReader(struct_name, fn_name, block, shapes)
+        self.writeFileReader(struct_name, fn_name, block, shapes, True)
+        self.writeMemReader(struct_name, fn_name, block, shapes, True)
+        self.writeFileWriter(struct_name, fn_name, block)
+        self.writeMemWriter(struct_name, fn_name, block, top or block["size"] == None)
+        self.writeBufferWriter(struct_name, fn_name, block)
+        self.writeJsonDumper(struct_name, fn_name, block, shapes)
+        self.writeJsonStreamer(fn_name, block, shapes)
+
+    # Returns the name and length of the table of an enum's value names,
+    # writing the table the first time it is used.
+    def nameTable(self, enum_name):
+        values = self.enum_defs[enum_name]
+        if len(values) == 0:
+            return ("NULL", "0")
+        table = "bottle_names_" + enum_name
+        if not (enum_name in self.name_tables):
+            self.name_tables.append(enum_name)
+            self.c.write("static const char *const " + table + "[] = {" + ", ".join([json.dumps(v) for v in values]) + "};" + self.nl + self.nl)
+        return (table, "NUM_" + capitalize(enum_name))
+
+    def writeJsonHelpers(self, block):
+        if not self.wrote_json:
+            self.c.write(c_json)
+            self.wrote_json = True
+        for var in block["fields"]:
+            if var["kind"] == "enum":
+                self.nameTable(var["type"])
+        if block["children"] != None:
+            self.nameTable(block["children"]["enum"])
+
+    # A C string literal writing a JSON key, preceded by sep.
+    def jsonKey(self, sep, name):
+        return '"' + (sep + json.dumps(name) + ":").replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+    def jsonValue(self, var, value):
+        t = var["type"]
+        if var["kind"] == "enum":
+            table, count = self.nameTable(t)
+            return "bottle_json_enum(to, " + table + ", " + count + ", " + value + ");"
+        elif t == "float":
+            return "bottle_json_number(to, " + value + ", 9);"
+        elif t == "double":
+            return "bottle_json_number(to, " + value + ", 17);"
+        elif t == "u64":
+            return 'fprintf(to, "%llu", (unsigned long long)' + value + ");"
+        elif t == "i64":
+            return 'fprintf(to, "%lld", (long long)' + value + ");"
+        elif t[0] == "u":
+            return 'fprintf(to, "%lu", (unsigned long)' + value + ");"
+        return 'fprintf(to, "%ld", (long)' + value + ");"
+
+    # Writes a decoded struct as a single line JSON object. Fields are in file
+    # order, followed by the children tag as an enum name, and then the child
+    # as an object named after its variant.
+    def writeJsonDumper(self, struct_name, fn_name, block, shapes):
+        tab = self.tab
+        nl = self.nl
+        self.writeJsonHelpers(block)
+        self.c.write("static void bottle_dump_" + fn_name + "_json(const struct " + struct_name + " *from, FILE *to){" + nl)
+        sep = "{"
+        for var in block["fields"]:
+            member = "from->" + self.member(var)
+            self.c.write(tab + "fputs(" + self.jsonKey(sep, var["name"]) + ", to);" + nl)
+            sep = ","
+            if var["type"] == "string":
+                self.c.write(tab + "bottle_json_string(to, (const unsigned char*)" + member + ".str, " + member + ".len);" + nl)
+            elif "array" in var["attr"]:
+                self.c.write(tab + "{" + nl)
+                self.c.write(tab + tab + "unsigned i;" + nl)
+                self.c.write(tab + tab + "fputc('[', to);" + nl)
+                self.c.write(tab + tab + "for(i = 0; i < " + member + ".len; i++){" + nl)
+                self.c.write(tab + tab + tab + "if(i != 0) fputc(',', to);" + nl)
+                self.c.write(tab + tab + tab + self.jsonValue(var, member + ".data[i]") + nl)
+                self.c.write(tab + tab + "}" + nl)
+                self.c.write(tab + tab + "fputc(']', to);" + nl)
+                self.c.write(tab + "}" + nl)
+            else:
+                self.c.write(tab + self.jsonValue(var, member) + nl)
+        if block["children"] != None:
+            children = block["children"]
+            enum_name_u = capitalize(children["enum"])
+            table, count = self.nameTable(children["enum"])
+            self.c.write(tab + "fputs(" + self.jsonKey(sep, children["enum"]) + ", to);" + nl)
+            sep = ","
+            self.c.write(tab + "bottle_json_enum(to, " + table + ", " + count + ", from->" + enum_name_u + ");" + nl)
+            self.c.write(tab + "switch(from->" + enum_name_u + "){" + nl)
+            for key in self.childKeys(children):
+                child_fn = shapes[key][1]
+                self.c.write(tab + tab + "case e" + capitalize(key) + ":" + nl)
+                self.c.write(tab + tab + tab + "fputs(" + self.jsonKey(sep, key) + ", to);" + nl)
+                self.c.write(tab + tab + tab + "bottle_dump_" + child_fn + "_json(" + self.childPointer("from", children, key) + ", to);" + nl)
+                self.c.write(tab + tab + tab + "break;" + nl)
+            self.c.write(tab + tab + "default: break;" + nl)
+            self.c.write(tab + "}" + nl)
+        if sep == "{":
+            self.c.write(tab + "(void)from;" + nl)
+            self.c.write(tab + 'fputs("{}", to);' + nl)
+        else:
+            self.c.write(tab + "fputc('}', to);" + nl)
+        self.c.write("}" + nl + nl)
+
+    # Converts an encoded block straight from the stream to the same JSON as
+    # bottle_dump_*_json, without decoding it into a struct or allocating.
+    def writeJsonStreamer(self, fn_name, block, shapes):
+        tab = self.tab
+        nl = self.nl
+        self.c.write("static unsigned bottle_stream_" + fn_name + "_json(FILE *from, FILE *to){" + nl)
+        sep = "{"
+        for var in block["fields"]:
+            self.c.write(tab + "fputs(" + self.jsonKey(sep, var["name"]) + ", to);" + nl)
+            sep = ","
+            if var["type"] == "string":
+                self.c.write(tab + "{" + nl)
+                self.c.write(tab + tab + "unsigned char buf[255];" + nl)
+                self.c.write(tab + tab + "const int len = fgetc(from);" + nl)
+                self.c.write(tab + tab + "if(len == EOF || fread(buf, 1, len, from) != (size_t)len) return BOTTLE_FAIL;" + nl)
+                self.c.write(tab + tab + "bottle_json_string(to, buf, len);" + nl)
+                self.c.write(tab + "}" + nl)
+            elif "array" in var["attr"]:
+                self.c.write(tab + "{" + nl)
+                self.c.write(tab + tab + "unsigned i, n;" + nl)
+                self.c.write(tab + tab + C_TYPES[var["type"]] + " v;" + nl)
+                self.c.write(tab + tab + "if(fread(&n, 1, 4, from) != 4) return BOTTLE_FAIL;" + nl)
+                self.c.write(tab + tab + "fputc('[', to);" + nl)
+                self.c.write(tab + tab + "for(i = 0; i < n; i++){" + nl)
+                self.c.write(tab + tab + tab + "if(fread(&v, sizeof(v), 1, from) != 1) return BOTTLE_FAIL;" + nl)
+                self.c.write(tab + tab + tab + "if(i != 0) fputc(',', to);" + nl)
+                self.c.write(tab + tab + tab + self.jsonValue(var, "v") + nl)
+                self.c.write(tab + tab + "}" + nl)
+                self.c.write(tab + tab + "fputc(']', to);" + nl)
+                self.c.write(tab + "}" + nl)
+            else:
+                if var["kind"] == "enum":
+                    c_type = "unsigned"
+                else:
+                    c_type = C_TYPES[var["type"]]
+                self.c.write(tab + "{" + nl)
+                self.c.write(tab + tab + c_type + " v;" + nl)
+                self.c.write(tab + tab + "if(fread(&v, 1, " + str(var["size"]) + ", from) != " + str(var["size"]) + ") return BOTTLE_FAIL;" + nl)
+                self.c.write(tab + tab + self.jsonValue(var, "v") + nl)
+                self.c.write(tab + "}" + nl)
+        if block["children"] != None:
+            children = block["children"]
+            enum_name_u = capitalize(children["enum"])
+            table, count = self.nameTable(children["enum"])
+            self.c.write(tab + "fputs(" + self.jsonKey(sep, children["enum"]) + ", to);" + nl)
+            sep = ","
+            self.c.write(tab + "{" + nl)
+            self.c.write(tab + tab + "const int tag = fgetc(from);" + nl)
+            self.c.write(tab + tab + "if(tag < 0 || tag >= NUM_" + enum_name_u + ") return BOTTLE_FAIL;" + nl)
+            self.c.write(tab + tab + "bottle_json_enum(to, " + table + ", " + count + ", tag);" + nl)
+            self.c.write(tab + tab + "switch(tag){" + nl)
+            for key in self.childKeys(children):
+                child_fn = shapes[key][1]
+                self.c.write(tab + tab + tab + "case e" + capitalize(key) + ":" + nl)
+                self.c.write(tab + tab + tab + tab + "fputs(" + self.jsonKey(sep, key) + ", to);" + nl)
+                self.c.write(tab + tab + tab + tab + "if(bottle_stream_" + child_fn + "_json(from, to) != BOTTLE_OK) return BOTTLE_FAIL;" + nl)
+                self.c.write(tab + tab + tab + tab + "break;" + nl)
+            self.c.write(tab + tab + tab + "default: break;" + nl)
+            self.c.write(tab + tab + "}" + nl)
+            self.c.write(tab + "}" + nl)
+        if sep == "{":
+            self.c.write(tab + "(void)from;" + nl)
+            self.c.write(tab + 'fputs("{}", to);' + nl)
+        else:
+            self.c.write(tab + "fputc('}', to);" + nl)
+        self.c.write(tab + "return BOTTLE_OK;" + nl + "}" + nl + nl)
+
+    # Consecutive fixed-size fields share a single reservation in the
+    # BottleWriter's buffer, so a record costs a few memcpys and no stdio calls.
+    def writeBufferWriter(self, struct_name, fn_name, block):
+        tab = self.tab
+        nl = self.nl
+        if not self.wrote_writer_put:
+            for var in block["fields"]:
+                if var["kind"] == "array":
+                    self.c.write(c_writer_put)
+                    self.wrote_writer_put = True
+                    break
+        self.c.write("static void bottle_write_" + fn_name + "_writer(const struct " + struct_name + " *from," + nl)
+        self.c.write(tab + "struct BottleWriter *to){" + nl)
+        if block["empty"]:
+            self.c.write(tab + "(void)from;" + nl + tab + "(void)to;" + nl + "}" + nl + nl)
+            return
+        self.c.write(tab + "unsigned char *at;" + nl)
+        run = []
+        for var in block["fields"]:
+            member = "from->" + self.member(var)
+            if var["type"] == "string" or "array" in var["attr"]:
+                self.writeWriterRun(run)
+                run = []
+            if var["type"] == "string":
+                self.c.write(tab + "at = bottle_writer_reserve(to, 1 + " + member + ".len);" + nl)
+                self.c.write(tab + "at[0] = " + member + ".len;" + nl)
+                self.c.write(tab + "if(" + member + ".len != 0) memcpy(at + 1, " + member + ".str, " + member + ".len);" + nl)
+            elif "array" in var["attr"]:
+                self.c.write(tab + "at = bottle_writer_reserve(to, 4);" + nl)
+                self.c.write(tab + "memcpy(at, &(" + member + ".len), 4);" + nl)
+                self.c.write(tab + "bottle_writer_put(to, " + member + ".data, " + member + ".len * sizeof(" + C_TYPES[var["type"]] + "));" + nl)
+            elif var["kind"] == "enum":
+                run.append(("{ const unsigned i = " + member + "; memcpy(at + %d, &i, 4); }", 4))
+            else:
+                size = var["size"]
+                run.append(("memcpy(at + %d, &(" + member + "), " + str(size) + ");", size))
+        if block["children"] != None:
+            children = block["children"]
+            enum_name_u = capitalize(children["enum"])
+            run.append(("at[%d] = from->" + enum_name_u + ";", 1))
+            self.writeWriterRun(run)
+            self.writeVariantCall(fn_name, children, "from", "write_writer", "to")
+        else:
+            self.writeWriterRun(run)
+        self.c.write("}" + nl + nl)
+
+    def writeWriterRun(self, run):
+        if len(run) == 0:
+            return
+        size = 0
+        for code, n in run:
+            size += n
+        self.c.write(self.tab + "at = bottle_writer_reserve(to, " + str(size) + ");" + self.nl)
+        offset = 0
+        for code, n in run:
+            self.c.write(self.tab + (code % offset) + self.nl)
+            offset += n
+
+    # Bottle_Project<Block>File/Mem read only the fields named with --project,
+    # leaving the other members of the struct untouched.
+    def writeProjection(self, block):
+        tab = self.tab
+        nl = self.nl
+        block_name = block["name"]
+        cap_name = capitalize(block_name)
+        struct_name = "Bottle" + cap_name
+        fn_name = str(block_name)
+        fields = self.project[block_name]
+        names = [var["name"] for var in block["fields"]]
+        if block["children"] != None:
+            names.append("children")
+        for field in fields:
+            if not (field in names):
+                raise BottleError("Projection of " + block_name + " has unknown field " + field)
+        shapes = {}
+        if block["children"] != None:
+            shapes = self.childShapes(block["children"])
+            if not ("children" in fields):
+                for variant in self.childVariants(block["children"]):
+                    self.writeSkipper(shapes[variant["name"]][1], variant["block"])
+        skipped = [name for name in names if not (name in fields)]
+        if len(skipped) != 0 and not self.wrote_skip_file:
+            self.c.write(c_skip_file)
+            self.wrote_skip_file = True
+        self.writeFileReader(struct_name, fn_name, block, shapes, False, fields)
+        self.writeMemReader(struct_name, fn_name, block, shapes, False, fields)
+
+        mem_projector = "unsigned Bottle_Project" + cap_name + "Mem(struct " + struct_name + " *out, const void *mem, unsigned len)"
+        file_projector = "unsigned Bottle_Project" + cap_name + "File(struct " + struct_name + " *out, FILE *from)"
+        self.h.write(mem_projector + ";" + nl)
+        self.h.write(file_projector + ";" + nl + nl)
+
+        self.c.write(mem_projector  +"{" + nl)
+        self.c.write(tab + "unsigned at = 0;" + nl)
+        self.c.write(tab + "return bottle_project_" + fn_name + "_mem(out, (const unsigned char*)mem, len, &at);" + nl)
+        self.c.write("}" + nl + nl)
+
+        self.c.write(file_projector  +"{" + nl)
+        self.c.write(tab + "return bottle_project_" + fn_name + "_file(out, from);" + nl)
+        self.c.write("}" + nl + nl)
+
+    def endBlocks(self):
+        for block_name in sorted(self.project.keys()):
+            if not (("Bottle" + capitalize(block_name)) in self.struct_names):
+                raise BottleError("Projection of unknown block " + block_name)
+
+    # Offset expression for a field, folding constants together.
+    def offsetExpr(self, base, offset):
+        if base is None:
+            return str(offset)
+        if offset == 0:
+            return base
+        return base + " + " + str(offset)
+
+    # Emits the code finding the end of the last string or array in before,
+    # which the offsets of the fields after it count from. Returns None when
+    # there is none, as offsets then count from the start of the block.
+    def fieldOffset(self, before):
+        tab = self.tab
+        nl = self.nl
+        base = None
+        for var in before:
+            if var["kind"] != "string" and var["kind"] != "array":
+                continue
+            at = self.offsetExpr(base, var["offset"])
+            if var["kind"] == "string":
+                self.c.write(tab + "if(len < " + self.offsetExpr(base, var["offset"] + 1) + ") return BOTTLE_FAIL;" + nl)
+                self.c.write(tab + "at = " + self.offsetExpr(base, var["offset"] + 1) + " + (size_t)mem[" + at + "];" + nl)
+            else:
+                data = self.offsetExpr(base, var["offset"] + 4)
+                self.writeCountCheck(at, data, var["size"])
+                if var["size"] == 1:
+                    self.c.write(tab + "at = " + data + " + n;" + nl)
+                else:
+                    self.c.write(tab + "at = " + data + " + (size_t)n * " + str(var["size"]) + ";" + nl)
+            base = "at"
+        return base
+
+    # Reads an array count, checking that its elements fit in the buffer.
+    def writeCountCheck(self, at, data, size):
+        tab = self.tab
+        nl = self.nl
+        if " " in data:
+            remaining = "(len - (" + data + "))"
+        else:
+            remaining = "(len - " + data + ")"
+        if size != 1:
+            remaining += " / " + str(size)
+        self.c.write(tab + "if(len < " + data + ") return BOTTLE_FAIL;" + nl)
+        self.c.write(tab + "memcpy(&n, mem + " + at + ", 4);" + nl)
+        self.c.write(tab + "if(" + remaining + " < n) return BOTTLE_FAIL;" + nl)
+
+    # Bottle_Get<Block>_<field> reads a single field straight out of an encoded
+    # block, without decoding the rest of it or allocating anything. Strings
+    # and arrays point into the buffer, and array elements may be unaligned.
+    def writeAccessors(self, cap_name, block):
+        tab = self.tab
+        nl = self.nl
+        before = []
+        for var in block["fields"]:
+            accessor = "unsigned Bottle_Get" + cap_name + "_" + var["name"] + "(const void *buf, size_t len, "
+            if var["type"] == "string":
+                accessor += "const char **out, unsigned *out_len)"
+            elif "array" in var["attr"]:
+                accessor += "const void **out, unsigned *out_len)"
+            elif var["kind"] == "enum":
+                accessor += "enum EnumBottle" + capitalize(var["type"]) + " *out)"
+            else:
+                accessor += C_TYPES[var["type"]] + " *out)"
+            self.h.write(accessor + ";" + nl)
+
+            self.c.write(accessor + "{" + nl)
+            self.c.write(tab + "const unsigned char *const mem = (const unsigned char*)buf;" + nl)
+            if [v for v in before if v["type"] == "string" or "array" in v["attr"]]:
+                self.c.write(tab + "size_t at;" + nl)
+            if "array" in var["attr"] or [v for v in before if "array" in v["attr"]]:
+                self.c.write(tab + "unsigned n;" + nl)
+            base = self.fieldOffset(before)
+            offset = var["offset"]
+            at = self.offsetExpr(base, offset)
+            if var["type"] == "string":
+                data = self.offsetExpr(base, offset + 1)
+                self.c.write(tab + "if(len < " + data + " || len < " + data + " + (size_t)mem[" + at + "]) return BOTTLE_FAIL;" + nl)
+                self.c.write(tab + "out[0] = (const char*)mem + " + data + ";" + nl)
+                self.c.write(tab + "out_len[0] = mem[" + at + "];" + nl)
+            elif "array" in var["attr"]:
+                data = self.offsetExpr(base, offset + 4)
+                self.writeCountCheck(at, data, var["size"])
+                self.c.write(tab + "out[0] = mem + " + data + ";" + nl)
+                self.c.write(tab + "out_len[0] = n;" + nl)
+            else:
+                size = var["size"]
+                self.c.write(tab + "if(len < " + self.offsetExpr(base, offset + size) + ") return BOTTLE_FAIL;" + nl)
+                if var["kind"] == "enum":
+                    self.c.write(tab + "{ unsigned i; memcpy(&i, mem + " + at + ", 4);" + nl)
+                    self.c.write(tab + tab + "out[0] = i; }" + nl)
+                else:
+                    self.c.write(tab + "memcpy(out, mem + " + at + ", " + str(size) + ");" + nl)
+            self.c.write(tab + "return BOTTLE_OK;" + nl)
+            self.c.write("}" + nl + nl)
+            before.append(var)
+        self.h.write(nl)
+
+    # Decodes consecutive records until max are read or one doesn't fit. When
+    # every record is the same size the count is known up front, and nothing
+    # can fail or allocate. Otherwise each record is read with the reloader
+    # into a zeroed struct, so that a record that fails part way can be freed.
+    def writeArrayReader(self, array_reader, fn_name, block):
+        tab = self.tab
+        nl = self.nl
+        self.c.write(array_reader + "{" + nl)
+        self.c.write(tab + "const unsigned char *const from = (const unsigned char*)mem;" + nl)
+        self.c.write(tab + "const unsigned limit = len > UINT_MAX ? UINT_MAX : (unsigned)len;" + nl)
+        self.c.write(tab + "unsigned at = 0;" + nl)
+        self.c.write(tab + "size_t n = 0;" + nl)
+        if block["size"] != None and block["size"] != 0:
+            self.c.write(tab + "if(max > limit / " + str(block["size"]) + ")" + nl)
+            self.c.write(tab + tab + "max = limit / " + str(block["size"]) + ";" + nl)
+            self.c.write(tab + "for(; n < max; n++){" + nl)
+            self.c.write(tab + tab + "if(limit - at > BOTTLE_PREFETCH_DISTANCE)" + nl)
+            self.c.write(tab + tab + tab + "BOTTLE_PREFETCH(from + at + BOTTLE_PREFETCH_DISTANCE);" + nl)
+            self.c.write(tab + tab + "bottle_read_" + fn_name + "_mem(out + n, from, limit, &at);" + nl)
+            self.c.write(tab + "}" + nl)
+        else:
+            self.c.write(tab + "for(; n < max; n++){" + nl)
+            self.c.write(tab + tab + "const unsigned start = at;" + nl)
+            self.c.write(tab + tab + "if(limit - at > BOTTLE_PREFETCH_DISTANCE)" + nl)
+            self.c.write(tab + tab + tab + "BOTTLE_PREFETCH(from + at + BOTTLE_PREFETCH_DISTANCE);" + nl)
+            self.c.write(tab + tab + "memset(out + n, 0, sizeof(out[n]));" + nl)
+            self.c.write(tab + tab + "if(bottle_reload_" + fn_name + "_mem(out + n, from, limit, &at) != BOTTLE_OK){" + nl)
+            self.c.write(tab + tab + tab + "bottle_free_" + fn_name + "(out + n);" + nl)
+            self.c.write(tab + tab + tab + "at = start;" + nl)
+            self.c.write(tab + tab + tab + "break;" + nl)
+            self.c.write(tab + tab + "}" + nl)
+            self.c.write(tab + "}" + nl)
+        self.c.write(tab + "if(consumed != NULL) consumed[0] = at;" + nl)
+        self.c.write(tab + "return n;" + nl)
+        self.c.write("}" + nl + nl)
+
+    def writeBlock(self, block):
+        tab = self.tab
+        nl = self.nl
+        block_name = block["name"]
+        cap_name = capitalize(block_name)
+        struct_name = "Bottle" + cap_name
+        fn_name = block_name
+        self.struct_names.append(struct_name)
+
+        mem_reader = "unsigned Bottle_Load" + cap_name + "Mem(struct " + struct_name + " *out, const void *mem, unsigned len)"
+        file_reader = "unsigned Bottle_Load" + cap_name + "File(struct " + struct_name + " *out, FILE *from)"
+        mem_reloader = "unsigned Bottle_Reload" + cap_name + "Mem(struct " + struct_name + " *out, const void *mem, unsigned len)"
+        file_reloader = "unsigned Bottle_Reload" + cap_name + "File(struct " + struct_name + " *out, FILE *from)"
+        destructor = "void Bottle_Free" + cap_name + "(struct " + struct_name + " *b)"
+        
+        mem_writer = "void *Bottle_Write" + cap_name + "Mem(const struct " + struct_name + "* from, unsigned *size_out)"
+        file_writer = "void Bottle_Write" + cap_name + "File(const struct " + struct_name + "* from, FILE *to)"
+        buffer_writer = "unsigned Bottle_Write" + cap_name + "Writer(const struct " + struct_name + "* from, struct BottleWriter *to)"
+        array_reader = "size_t Bottle_Load" + cap_name + "ArrayMem(const void *mem, size_t len, struct " + struct_name + " *out, size_t max, size_t *consumed)"
+        json_dumper = "void Bottle_Dump" + cap_name + "Json(FILE *to, const struct " + struct_name + " *from)"
+        json_streamer = "unsigned Bottle_Stream" + cap_name + "Json(FILE *from, FILE *to)"
         
-        if "children" in block:
-            self.writeChildren(block["children"], tabs+1)
-        if write_struct:
-            self.h.write(calcTabs(tabs - 1) + "};" + nl)
+        self.h.write("struct " + struct_name + ";" + nl)
+        self.h.write(nl)
+        self.h.write(mem_reader + ";" + nl)
+        self.h.write(file_reader + ";" + nl)
+        self.h.write(mem_reloader + ";" + nl)
+        self.h.write(file_reloader + ";" + nl)
+        self.h.write(array_reader + ";" + nl)
+        self.h.write(destructor + ";" + nl)
+        self.h.write(mem_writer + ";" + nl)
+        self.h.write(file_writer + ";" + nl)
+        self.h.write(buffer_writer + ";" + nl)
+        self.h.write(json_dumper + ";" + nl)
+        self.h.write(json_streamer + ";" + nl)
+        self.h.write(nl)
+
+        self.writeShape(struct_name, fn_name, block)
+
+        self.c.write(mem_writer  +"{" + nl)
+        self.c.write(tab + "const unsigned size = bottle_size_" + fn_name + "(from);" + nl)
+        self.c.write(tab + "unsigned char *const to = (unsigned char*)malloc(size);" + nl)
+        self.c.write(tab + "unsigned at = 0;" + nl)
+        self.c.write(tab + "if(to == NULL) return NULL;" + nl)
+        self.c.write(tab + "bottle_write_" + fn_name + "_mem(from, to, &at);" + nl)
+        self.c.write(tab + "size_out[0] = size;" + nl)
+        self.c.write(tab + "return to;" + nl)
+        self.c.write("}" + nl + nl)
+
+        self.c.write(file_writer  +"{" + nl)
+        self.c.write(tab + "bottle_write_" + fn_name + "_file(from, to);" + nl)
+        self.c.write("}" + nl + nl)
+
+        self.c.write(buffer_writer  +"{" + nl)
+        self.c.write(tab + "bottle_write_" + fn_name + "_writer(from, to);" + nl)
+        self.c.write(tab + "return to->status;" + nl)
+        self.c.write("}" + nl + nl)
+
+        self.c.write(mem_reader  +"{" + nl)
+        self.c.write(tab + "unsigned at = 0;" + nl)
+        self.c.write(tab + "return bottle_read_" + fn_name + "_mem(out, (const unsigned char*)mem, len, &at);" + nl)
+        self.c.write("}" + nl + nl)
+
+        self.c.write(file_reader  +"{" + nl)
+        self.c.write(tab + "return bottle_read_" + fn_name + "_file(out, from);" + nl)
+        self.c.write("}" + nl + nl)
+
+        self.c.write(mem_reloader  +"{" + nl)
+        self.c.write(tab + "unsigned at = 0;" + nl)
+        self.c.write(tab + "return bottle_reload_" + fn_name + "_mem(out, (const unsigned char*)mem, len, &at);" + nl)
+        self.c.write("}" + nl + nl)
+
+        self.c.write(file_reloader  +"{" + nl)
+        self.c.write(tab + "return bottle_reload_" + fn_name + "_file(out, from);" + nl)
+        self.c.write("}" + nl + nl)
+
+        self.writeArrayReader(array_reader, fn_name, block)
+
+        self.c.write(destructor  +"{" + nl)
+        self.c.write(tab + "bottle_free_" + fn_name + "(b);" + nl)
+        self.c.write("}" + nl + nl)
+
+        self.c.write(json_dumper + "{" + nl)
+        self.c.write(tab + "bottle_dump_" + fn_name + "_json(from, to);" + nl)
+        self.c.write("}" + nl + nl)
+
+        # Converts every record up to the end of the stream, one per line.
+        self.c.write(json_streamer + "{" + nl)
+        self.c.write(tab + "int c;" + nl)
+        self.c.write(tab + "while((c = fgetc(from)) != EOF){" + nl)
+        self.c.write(tab + tab + "ungetc(c, from);" + nl)
+        self.c.write(tab + tab + "if(bottle_stream_" + fn_name + "_json(from, to) != BOTTLE_OK) return BOTTLE_FAIL;" + nl)
+        self.c.write(tab + tab + "fputc('\\n', to);" + nl)
+        self.c.write(tab + "}" + nl)
+        self.c.write(tab + "return ferror(from) ? BOTTLE_FAIL : BOTTLE_OK;" + nl)
+        self.c.write("}" + nl + nl)
+
+        if block_name in self.project:
+            self.writeProjection(block)
+
+        self.writeAccessors(cap_name, block)
+
+
+# C++ Writer, emits a single header of inline codecs. Decoding never copies or
+# allocates: strings and arrays are views into the buffer being decoded.
+cpp_common = """
+#ifndef BOTTLE_HPP_COMMON
+#define BOTTLE_HPP_COMMON
+namespace bottle {
+
+// Packed array elements inside an encoded buffer. The elements are not
+// necessarily aligned, so they are copied out on access.
+template<typename T>
+struct ArrayView {
+    std::span<const unsigned char> bytes;
+
+    constexpr ArrayView() noexcept = default;
+    ArrayView(std::span<const T> data) noexcept
+        : bytes(reinterpret_cast<const unsigned char*>(data.data()), data.size_bytes()) {}
+    constexpr std::size_t size() const noexcept { return bytes.size() / sizeof(T); }
+    T operator[](std::size_t i) const noexcept {
+        T v;
+        std::memcpy(&v, bytes.data() + i * sizeof(T), sizeof(T));
+        return v;
+    }
+};
+
+// The decoders expect at to be no more than in.size().
+inline bool getString(std::span<const unsigned char> in, std::size_t &at, std::string_view &out) noexcept {
+    if(in.size() - at < 1 || in.size() - at - 1 < in[at])
+        return false;
+    out = std::string_view(reinterpret_cast<const char*>(in.data() + at + 1), in[at]);
+    at += 1 + in[at];
+    return true;
+}
+
+template<typename T>
+inline bool getArray(std::span<const unsigned char> in, std::size_t &at, ArrayView<T> &out) noexcept {
+    std::uint32_t n;
+    if(in.size() - at < 4)
+        return false;
+    std::memcpy(&n, in.data() + at, 4);
+    at += 4;
+    if((in.size() - at) / sizeof(T) < n)
+        return false;
+    out.bytes = in.subspan(at, n * sizeof(T));
+    at += n * sizeof(T);
+    return true;
+}
+
+inline unsigned char *grow(std::vector<unsigned char> &out, std::size_t n) {
+    const std::size_t at = out.size();
+    out.resize(at + n);
+    return out.data() + at;
+}
+
+template<typename T>
+inline void put(unsigned char *to, T from) noexcept {
+    std::memcpy(to, &from, sizeof(T));
+}
+
+inline void putString(std::vector<unsigned char> &out, std::string_view from) {
+    const std::size_t n = from.size() < 256 ? from.size() : 255;
+    out.push_back(static_cast<unsigned char>(n));
+    out.insert(out.end(), from.data(), from.data() + n);
+}
+
+template<typename T>
+inline void putArray(std::vector<unsigned char> &out, const ArrayView<T> &from) {
+    const std::uint32_t n = static_cast<std::uint32_t>(from.size());
+    put(grow(out, 4), n);
+    out.insert(out.end(), from.bytes.begin(), from.bytes.begin() + n * sizeof(T));
+}
+
+}
+#endif
+"""
+
+class CPPWriter(Writer):
+    def __init__(self, name, tab = "    ", nl = "\n", out_dir = "."):
+        Writer.__init__(self, name, tab, nl, out_dir)
+
+    def open(self, name):
+        self.src_name = name
+        self.file = self.openOutput(name + ".hpp")
+        self.types = ""
+        self.functions = ""
+        self.enum_defs = {}
+
+    def close(self):
+        out = self.file
+        nl = self.nl
+        inc_guard = "BOTTLE_" + self.src_name.upper() + "_HPP"
+        out.write("// AUTOGENERATED, DO NOT EDIT" + nl)
+        out.write("// Created by libbottle generate.py, ")
+        out.write(str(datetime.date.today()) + nl + nl)
+        out.write("#ifndef " + inc_guard + nl)
+        out.write("#define " + inc_guard + nl + nl)
+        for header in ("cstddef", "cstdint", "cstring", "span", "string_view", "variant", "vector"):
+            out.write("#include <" + header + ">" + nl)
+        out.write(cpp_common.replace("\n", nl))
+        out.write(nl + "namespace bottle::" + self.src_name + " {" + nl + nl)
+        out.write(self.types)
+        out.write(self.functions)
+        out.write("}" + nl + nl + "#endif" + nl)
+        out.close()
+
+    def cppType(self, var):
+        if var["kind"] == "string":
+            return "std::string_view"
+        elif var["kind"] == "enum":
+            return capitalize(var["type"])
+        c_type = C_TYPES[var["type"]]
+        if c_type.endswith("_t"):
+            c_type = "std::" + c_type
+        if var["kind"] == "array":
+            return "bottle::ArrayView<" + c_type + ">"
+        return c_type
+
+    def writeEnum(self, enum):
+        self.enums.append(enum["name"])
+        self.enum_defs[enum["name"]] = enum["values"]
+        self.types += "enum class " + capitalize(enum["name"]) + " : std::uint32_t { " + ", ".join(enum["values"]) + " };" + self.nl + self.nl
+
+    # One alternative per enum value, in order, so the index of the variant is
+    # its tag. Values without a child get an empty struct.
+    def variantBlocks(self, children):
+        blocks = []
+        for value in self.enum_defs[children["enum"]]:
+            blocks.append((value, {"name":value, "fields":[], "children":None, "size":0, "empty":True}))
+        for variant in children["variants"]:
+            blocks[variant["tag"]] = (variant["name"], variant["block"])
+        return blocks
+
+    def structText(self, struct_name, block, tabs):
+        tabn = self.calcTabs(tabs)
+        nl = self.nl
+        if block["empty"]:
+            return tabn + "struct " + struct_name + " {" + nl + tabn + self.tab + "static constexpr std::size_t encoded_size = 0;" + nl + tabn + "};" + nl
+        text = tabn + "struct " + struct_name + " {" + nl
+        if block["size"] != None:
+            text += tabn + self.tab + "static constexpr std::size_t encoded_size = " + str(block["size"]) + ";" + nl
+        if block["children"] != None:
+            for value, child in self.variantBlocks(block["children"]):
+                text += self.structText(capitalize(value), child, tabs + 1)
+        for var in block["fields"]:
+            text += tabn + self.tab + self.cppType(var) + " " + var["name"] + ";" + nl
+        if block["children"] != None:
+            alternatives = [capitalize(value) for value, child in self.variantBlocks(block["children"])]
+            text += tabn + self.tab + "std::variant<" + ", ".join(alternatives) + "> " + block["children"]["enum"] + ";" + nl
+        return text + tabn + "};" + nl
+
+    # Runs of fixed-size fields are checked and advanced over once.
+    def decodeRun(self, run):
+        tab = self.tab
+        nl = self.nl
+        if len(run) == 0:
+            return ""
+        size = run[-1]["offset"] + run[-1]["size"]
+        text = tab + "if(in.size() - at < " + str(size) + ")" + nl + tab + tab + "return false;" + nl
+        for var in run:
+            at = "in.data() + at + " + str(var["offset"])
+            if var["kind"] == "enum":
+                text += tab + "{ std::uint32_t v; std::memcpy(&v, " + at + ", 4); out." + var["name"] + " = static_cast<" + self.cppType(var) + ">(v); }" + nl
+            else:
+                text += tab + "std::memcpy(&out." + var["name"] + ", " + at + ", " + str(var["size"]) + ");" + nl
+        return text + tab + "at += " + str(size) + ";" + nl
+
+    def encodeRun(self, run):
+        tab = self.tab
+        nl = self.nl
+        if len(run) == 0:
+            return ""
+        size = run[-1]["offset"] + run[-1]["size"]
+        text = tab + "{" + nl + tab + tab + "unsigned char *const to = bottle::grow(out, " + str(size) + ");" + nl
+        for var in run:
+            if var["kind"] == "enum":
+                value = "static_cast<std::uint32_t>(from." + var["name"] + ")"
+            else:
+                value = "from." + var["name"]
+            text += tab + tab + "bottle::put(to + " + str(var["offset"]) + ", " + value + ");" + nl
+        return text + tab + "}" + nl
+
+    # Children's functions are written first, since the block's call them.
+    def writeFunctions(self, qual, block, top):
+        tab = self.tab
+        nl = self.nl
+        children = block["children"]
+        if children != None:
+            for value, child in self.variantBlocks(children):
+                self.writeFunctions(qual + "::" + capitalize(value), child, False)
+
+        text = ""
+        if block["fields"] == [] and children == None:
+            text += "inline bool decode(std::span<const unsigned char>, std::size_t &, " + qual + " &) noexcept {" + nl
+            text += tab + "return true;" + nl + "}" + nl + nl
+        else:
+            text += "inline bool decode(std::span<const unsigned char> in, std::size_t &at, " + qual + " &out) noexcept {" + nl
+            run = []
+            for var in block["fields"]:
+                if var["kind"] == "fixed" or var["kind"] == "enum":
+                    run.append(var)
+                    continue
+                text += self.decodeRun(run)
+                run = []
+                if var["kind"] == "string":
+                    text += tab + "if(!bottle::getString(in, at, out." + var["name"] + "))" + nl
+                else:
+                    text += tab + "if(!bottle::getArray(in, at, out." + var["name"] + "))" + nl
+                text += tab + tab + "return false;" + nl
+            text += self.decodeRun(run)
+            if children != None:
+                member = "out." + children["enum"]
+                count = len(self.enum_defs[children["enum"]])
+                text += tab + "if(at >= in.size() || in[at] >= " + str(count) + ")" + nl + tab + tab + "return false;" + nl
+                text += tab + "switch(in[at++]){" + nl
+                for i in range(count):
+                    text += tab + tab + "case " + str(i) + ": return decode(in, at, " + member + ".emplace<" + str(i) + ">());" + nl
+                text += tab + "}" + nl
+            text += tab + "return true;" + nl + "}" + nl + nl
+        if top:
+            text += "inline bool decode(std::span<const unsigned char> in, " + qual + " &out) noexcept {" + nl
+            text += tab + "std::size_t at = 0;" + nl
+            text += tab + "return decode(in, at, out);" + nl + "}" + nl + nl
+
+        if block["size"] != None:
+            text += "constexpr std::size_t encodedSize(const " + qual + " &) noexcept {" + nl
+            text += tab + "return " + qual + "::encoded_size;" + nl + "}" + nl + nl
+        else:
+            size = 0
+            parts = []
+            for var in block["fields"]:
+                if var["kind"] == "string":
+                    size += 1
+                    parts.append("(from." + var["name"] + ".size() < 256 ? from." + var["name"] + ".size() : 255)")
+                elif var["kind"] == "array":
+                    size += 4
+                    parts.append("from." + var["name"] + ".size() * " + str(var["size"]))
+                else:
+                    size += var["size"]
+            if children != None:
+                size += 1
+            text += "inline std::size_t encodedSize(const " + qual + " &from) noexcept {" + nl
+            text += tab + "std::size_t size = " + " + ".join([str(size)] + parts) + ";" + nl
+            if children != None:
+                member = "from." + children["enum"]
+                text += tab + "switch(" + member + ".index()){" + nl
+                for i in range(len(self.enum_defs[children["enum"]])):
+                    text += tab + tab + "case " + str(i) + ": size += encodedSize(*std::get_if<" + str(i) + ">(&" + member + ")); break;" + nl
+                text += tab + "}" + nl
+            text += tab + "return size;" + nl + "}" + nl + nl
+
+        if block["fields"] == [] and children == None:
+            text += "inline void encode(const " + qual + " &, std::vector<unsigned char> &) {" + nl + "}" + nl + nl
+        else:
+            text += "inline void encode(const " + qual + " &from, std::vector<unsigned char> &out) {" + nl
+            run = []
+            for var in block["fields"]:
+                if var["kind"] == "fixed" or var["kind"] == "enum":
+                    run.append(var)
+                    continue
+                text += self.encodeRun(run)
+                run = []
+                if var["kind"] == "string":
+                    text += tab + "bottle::putString(out, from." + var["name"] + ");" + nl
+                else:
+                    text += tab + "bottle::putArray(out, from." + var["name"] + ");" + nl
+            text += self.encodeRun(run)
+            if children != None:
+                member = "from." + children["enum"]
+                text += tab + "out.push_back(static_cast<unsigned char>(" + member + ".index()));" + nl
+                text += tab + "switch(" + member + ".index()){" + nl
+                for i in range(len(self.enum_defs[children["enum"]])):
+                    text += tab + tab + "case " + str(i) + ": encode(*std::get_if<" + str(i) + ">(&" + member + "), out); break;" + nl
+                text += tab + "}" + nl
+            text += "}" + nl + nl
+        self.functions += text
+
+    def writeBlock(self, block):
+        struct_name = capitalize(block["name"])
+        self.types += self.structText(struct_name, block, 0) + self.nl
+        self.writeFunctions(struct_name, block, True)
 
 # Mercury Writer
 class MWriter(Writer):
 
-    def __init__(self, name):
-        Writer.__init__(self, name)
+    def __init__(self, name, tab = "    ", nl = "\n", out_dir = "."):
+        Writer.__init__(self, name, tab, nl, out_dir)
     
     def open(self, name):
         self.src_name = name
-        self.file = open(self.src_name + ".m", "wb")
+        self.file = self.openOutput(self.src_name + ".m")
         self.int = ""
         self.imp = ""
         self.small_types = ""
@@ -511,42 +2147,51 @@ class MWriter(Writer):
         self.converts = []
         self.enum_defs = {}
         self.written_types = []
+        self.array_types = []
+        self.sized_types = []
 
     def close(self):
         if len(self.int)==0 and len(self.imp)==0 and len(self.small_types)==0:
             return
         
         out = self.file
-        out.write(":- module " + self.src_name + "." + nl)
-        out.write("% AUTOGENERATED, DO NOT EDIT" + nl)
+        out.write(":- module " + self.src_name + "." + self.nl)
+        out.write("% AUTOGENERATED, DO NOT EDIT" + self.nl)
         out.write("% Created by libbottle generate.py, ")
         out.write(str(datetime.date.today()))
-        out.write(nl)
-        out.write(":- interface." + nl + nl)
-        out.write(":- import_module buffer." + nl + nl)
-        out.write(":- use_module io." + nl + nl)
+        out.write(self.nl)
+        out.write(":- interface." + self.nl + self.nl)
+        out.write(":- import_module buffer." + self.nl)
+        if len(self.array_types) != 0:
+            out.write(":- import_module array." + self.nl)
+        out.write(self.nl)
+        out.write(":- use_module io." + self.nl + self.nl)
         out.write(self.small_types)
-        out.write(nl)
+        out.write(self.nl)
         out.write(self.int)
-        out.write(nl)
+        out.write(self.nl)
         for convert in self.converts:
             name = convert["name"] + "_" + convert["child"]
+            if convert["empty"]:
+                out.write(":- func " + name + " = " + convert["name"] + "_data.")
+                out.write(self.nl + self.nl)
+                continue
             out.write(":- pred " + name)
             out.write("(" + convert["name"] + "_data, " + convert["child"] + ").")
-            out.write(nl)
+            out.write(self.nl)
             out.write(":- mode " + name)
             out.write("(in, out) is semidet.")
-            out.write(nl)
+            out.write(self.nl)
             out.write(":- mode " + name)
             out.write("(out, in) is det.")
-            out.write(nl)
-            out.write(nl)
-        out.write(nl)
-        out.write(":- implementation." + nl + nl)
-        out.write(":- import_module int." + nl)
-        out.write(":- use_module string." + nl)
-        out.write(":- use_module list." + nl)
-        out.write(":- use_module char." + nl)
+            out.write(self.nl)
+            out.write(self.nl)
+        out.write(self.nl)
+        out.write(":- implementation." + self.nl + self.nl)
+        out.write(":- import_module int." + self.nl)
+        out.write(":- use_module string." + self.nl)
+        out.write(":- use_module list." + self.nl)
+        out.write(":- use_module char." + self.nl)
         out.write("""
 
 :- pred write_string(string::in, int::in, int::in, io.io::di, io.io::uo) is det.
@@ -560,104 +2205,204 @@ write_string(Str, I, N, !IO) :-
         write_string(Str, I + 1, N, !IO)
     ).
 """)
-        out.write(":- pred float_to_bytes(float::in, int::out, int::out, int::out, int::out) is det." + nl)
-        out.write(":- pred bytes_to_float(float::out, int::in, int::in, int::in, int::in) is det." + nl)
-        out.write(":- pred int_to_bytes(int::in, int::out, int::out, int::out, int::out) is det." + nl)
-        out.write(":- pred bytes_to_int(int::out, int::in, int::in, int::in, int::in) is det." + nl)
-        out.write(':- pragma foreign_proc("C", float_to_bytes(In::in, O0::out, O1::out, O2::out, O3::out),' + nl)
-        out.write(tab + "[promise_pure, thread_safe, does_not_affect_liveness, will_not_call_mercury, will_not_throw_exception]," + nl)
-        out.write(tab + '"const float f=In;const unsigned char *const uc=(unsigned char*)&f;'+nl+tab)
+        out.write(":- pred float_to_bytes(float::in, int::out, int::out, int::out, int::out) is det." + self.nl)
+        out.write(":- pred bytes_to_float(float::out, int::in, int::in, int::in, int::in) is det." + self.nl)
+        out.write(":- pred int_to_bytes(int::in, int::out, int::out, int::out, int::out) is det." + self.nl)
+        out.write(":- pred bytes_to_int(int::out, int::in, int::in, int::in, int::in) is det." + self.nl)
+        out.write(':- pragma foreign_proc("C", float_to_bytes(In::in, O0::out, O1::out, O2::out, O3::out),' + self.nl)
+        out.write(self.tab + "[promise_pure, thread_safe, does_not_affect_liveness, will_not_call_mercury, will_not_throw_exception]," + self.nl)
+        out.write(self.tab + '"const float f=In;const unsigned char *const uc=(unsigned char*)&f;'+self.nl+self.tab)
         i = 0
         while i < 4:
             si = str(i)
             out.write("O" + si + "=uc[" + si + "];")
             i += 1
-        out.write(tab + '").' + nl)
+        out.write(self.tab + '").' + self.nl)
 
-        out.write(':- pragma foreign_proc("C", bytes_to_float(Out::out, I0::in, I1::in, I2::in, I3::in),' + nl)
-        out.write(tab + "[promise_pure, thread_safe, does_not_affect_liveness, will_not_call_mercury, will_not_throw_exception]," + nl)
-        out.write(tab + '"float f;unsigned char *const uc=(unsigned char*)&f;'+nl+tab)
+        out.write(':- pragma foreign_proc("C", bytes_to_float(Out::out, I0::in, I1::in, I2::in, I3::in),' + self.nl)
+        out.write(self.tab + "[promise_pure, thread_safe, does_not_affect_liveness, will_not_call_mercury, will_not_throw_exception]," + self.nl)
+        out.write(self.tab + '"float f;unsigned char *const uc=(unsigned char*)&f;'+self.nl+self.tab)
         i = 0
         while i < 4:
             si = str(i)
             out.write("uc[" + si + "]=I" + si + ";")
             i += 1
-        out.write(tab + "Out = f;" + nl)
-        out.write(tab + '").' + nl)
+        out.write(self.tab + "Out = f;" + self.nl)
+        out.write(self.tab + '").' + self.nl)
         
-        out.write(':- pragma foreign_proc("C", int_to_bytes(In::in, O0::out, O1::out, O2::out, O3::out),' + nl)
-        out.write(tab + "[promise_pure, thread_safe, does_not_affect_liveness, will_not_call_mercury, will_not_throw_exception]," + nl)
-        out.write(tab + '"const int i=In;const unsigned char *const uc=(unsigned char*)&i;'+nl+tab)
+        out.write(':- pragma foreign_proc("C", int_to_bytes(In::in, O0::out, O1::out, O2::out, O3::out),' + self.nl)
+        out.write(self.tab + "[promise_pure, thread_safe, does_not_affect_liveness, will_not_call_mercury, will_not_throw_exception]," + self.nl)
+        out.write(self.tab + '"const int i=In;const unsigned char *const uc=(unsigned char*)&i;'+self.nl+self.tab)
         i = 0
         while i < 4:
             si = str(i)
             out.write("O" + si + "=uc[" + si + "];")
             i += 1
-        out.write(tab + '").' + nl)
+        out.write(self.tab + '").' + self.nl)
 
-        out.write(':- pragma foreign_proc("C", bytes_to_int(Out::out, I0::in, I1::in, I2::in, I3::in),' + nl)
-        out.write(tab + "[promise_pure, thread_safe, does_not_affect_liveness, will_not_call_mercury, will_not_throw_exception]," + nl)
-        out.write(tab + '"int i;unsigned char *const uc=(unsigned char*)&i;'+nl+tab)
+        out.write(':- pragma foreign_proc("C", bytes_to_int(Out::out, I0::in, I1::in, I2::in, I3::in),' + self.nl)
+        out.write(self.tab + "[promise_pure, thread_safe, does_not_affect_liveness, will_not_call_mercury, will_not_throw_exception]," + self.nl)
+        out.write(self.tab + '"int i;unsigned char *const uc=(unsigned char*)&i;'+self.nl+self.tab)
         i = 0
         while i < 4:
             si = str(i)
             out.write("uc[" + si + "]=I" + si + ";")
             i += 1
-        out.write(tab + "Out = i;" + nl)
-        out.write(tab + '").' + nl + nl)
+        out.write(self.tab + "Out = i;" + self.nl)
+        out.write(self.tab + '").' + self.nl + self.nl)
         
+        if len(self.sized_types) != 0:
+            out.write(':- pragma foreign_decl("C", "#include <stdint.h>").' + self.nl + self.nl)
+        for t in self.sized_types:
+            self.writeSizedPreds(t)
+
+        for t in self.array_types:
+            self.writeArrayPreds(t)
+
         for foreign_export in self.foreign_exports:
             out.write(foreign_export)
-            out.write(nl)
+            out.write(self.nl)
         
         for convert in self.converts:
             name = convert["name"]
             child = convert["child"]
-            out.write(name + "_type(" + child + "(_)) = " + child + "." + nl)
             predname = name + "_" + child
-            out.write(predname + "(" + child + "(That), That)." + nl)
+            if convert["empty"]:
+                out.write(name + "_type(" + child + ") = " + child + "." + self.nl)
+                out.write(predname + " = " + child + "." + self.nl)
+                out.write(':- pragma foreign_export("C", ')
+                out.write(predname + ' = (out), ')
+                out.write('"' + capitalize(self.src_name) + '_Create' + capitalize(predname) + '").' + self.nl)
+                out.write(self.nl)
+                continue
+            out.write(name + "_type(" + child + "(_)) = " + child + "." + self.nl)
+            out.write(predname + "(" + child + "(That), That)." + self.nl)
             out.write(':- pragma foreign_export("C", ')
             out.write(predname + '(in, out), ')
-            out.write('"' + capitalize(self.src_name) + '_Get' + capitalize(predname) + '").' + nl)
+            out.write('"' + capitalize(self.src_name) + '_Get' + capitalize(predname) + '").' + self.nl)
             out.write(':- pragma foreign_export("C", ')
             out.write(predname + '(out, in), ')
-            out.write('"' + capitalize(self.src_name) + '_Create' + capitalize(predname) + '").' + nl)
-            out.write(nl)
-        out.write(nl)
+            out.write('"' + capitalize(self.src_name) + '_Create' + capitalize(predname) + '").' + self.nl)
+            out.write(self.nl)
+        out.write(self.nl)
         
         out.write(self.imp)
-        out.write(nl)
+        out.write(self.nl)
 
         self.small_types = ""
         self.int = ""
         self.imp = ""
+
+    def mercuryType(self, var):
+        t = MERCURY_TYPES.get(var["type"], var["type"])
+        if "array" in var["attr"]:
+            return "array(" + t + ")"
+        return t
+
+    def useSized(self, t):
+        if t in SIZED_TYPES and not (t in self.sized_types):
+            self.sized_types.append(t)
+
+    # get_T and put_T read and write a sized value in native byte order.
+    def writeSizedPreds(self, t):
+        out = self.file
+        tab = self.tab
+        nl = self.nl
+        m_type = MERCURY_TYPES[t]
+        c_type = C_TYPES[t]
+        n = TYPE_SIZES[t]
+        ins = ", ".join(["I" + str(i) + "::in" for i in range(n)])
+        outs = ", ".join(["O" + str(i) + "::out" for i in range(n)])
+        attrs = tab + "[promise_pure, thread_safe, does_not_affect_liveness, will_not_call_mercury, will_not_throw_exception]," + nl
+
+        out.write(":- pred get_" + t + "(buffer::in, int::in, " + m_type + "::out) is semidet." + nl)
+        out.write("get_" + t + "(Buffer, I, Value) :-" + nl)
+        for i in range(n):
+            out.write(tab + "get_8(Buffer, I + " + str(i) + ", B" + str(i) + ")," + nl)
+        out.write(tab + "bytes_to_" + t + "(Value, " + ", ".join(["B" + str(i) for i in range(n)]) + ")." + nl)
+        out.write(":- pred bytes_to_" + t + "(" + m_type + "::out" + ", int::in" * n + ") is det." + nl)
+        out.write(':- pragma foreign_proc("C", bytes_to_' + t + "(Out::out, " + ins + ")," + nl)
+        out.write(attrs)
+        out.write(tab + '"' + c_type + " v;unsigned char *const uc=(unsigned char*)&v;" + nl + tab)
+        for i in range(n):
+            out.write("uc[" + str(i) + "]=I" + str(i) + ";")
+        out.write("Out = v;" + nl)
+        out.write(tab + '").' + nl + nl)
+
+        out.write(":- pred put_" + t + "(" + m_type + "::in, io.io::di, io.io::uo) is det." + nl)
+        out.write("put_" + t + "(Value, !IO) :-" + nl)
+        out.write(tab + t + "_to_bytes(Value, " + ", ".join(["B" + str(i) for i in range(n)]) + ")," + nl)
+        out.write(tab + ", ".join(["io.write_byte(B" + str(i) + ", !IO)" for i in range(n)]) + "." + nl)
+        out.write(":- pred " + t + "_to_bytes(" + m_type + "::in" + ", int::out" * n + ") is det." + nl)
+        out.write(':- pragma foreign_proc("C", ' + t + "_to_bytes(In::in, " + outs + ")," + nl)
+        out.write(attrs)
+        out.write(tab + '"const ' + c_type + " v=In;const unsigned char *const uc=(const unsigned char*)&v;" + nl + tab)
+        for i in range(n):
+            out.write("O" + str(i) + "=uc[" + str(i) + "];")
+        out.write(nl + tab + '").' + nl + nl)
+
+    # Array elements are read back to front, so the list is built in order.
+    def writeArrayPreds(self, t):
+        out = self.file
+        tab = self.tab
+        nl = self.nl
+        size = str(TYPE_SIZES[t])
+        m_type = MERCURY_TYPES[t]
+        if t == "float":
+            get, put = "get_byte_float", "write_float_element"
+        elif t == "int":
+            get, put = "get_byte_32", "write_int_element"
+        else:
+            get, put = "get_" + t, "put_" + t
+        out.write(":- pred read_" + t + "_array(buffer::in, int::in, int::in, array(" + m_type + ")::out) is semidet." + nl)
+        out.write("read_" + t + "_array(Buffer, I, N, Array) :-" + nl)
+        out.write(tab + "read_" + t + "_list(Buffer, I + (N - 1) * " + size + ", N, [], List)," + nl)
+        out.write(tab + "Array = array.from_list(List)." + nl + nl)
+        out.write(":- pred read_" + t + "_list(buffer::in, int::in, int::in, list.list(" + m_type + ")::in, list.list(" + m_type + ")::out) is semidet." + nl)
+        out.write("read_" + t + "_list(Buffer, I, N, List0, List) :-" + nl)
+        out.write(tab + "( N = 0 ->" + nl)
+        out.write(tab + tab + "List = List0" + nl)
+        out.write(tab + ";" + nl)
+        out.write(tab + tab + get + "(Buffer, I, Value)," + nl)
+        out.write(tab + tab + "read_" + t + "_list(Buffer, I - " + size + ", N - 1, [Value | List0], List)" + nl)
+        out.write(tab + ")." + nl + nl)
+        out.write(":- pred write_" + t + "_array(array(" + m_type + ")::in, io.io::di, io.io::uo) is det." + nl)
+        out.write("write_" + t + "_array(Array, !IO) :-" + nl)
+        out.write(tab + "int_to_bytes(array.size(Array), C0, C1, C2, C3)," + nl)
+        out.write(tab + "io.write_byte(C0, !IO), io.write_byte(C1, !IO), io.write_byte(C2, !IO), io.write_byte(C3, !IO)," + nl)
+        out.write(tab + "array.foldl(" + put + ", Array, !IO)." + nl + nl)
+        if t == "int" or t == "float":
+            out.write(":- pred " + put + "(" + t + "::in, io.io::di, io.io::uo) is det." + nl)
+            out.write(put + "(Value, !IO) :-" + nl)
+            out.write(tab + t + "_to_bytes(Value, B0, B1, B2, B3)," + nl)
+            out.write(tab + "io.write_byte(B0, !IO), io.write_byte(B1, !IO), io.write_byte(B2, !IO), io.write_byte(B3, !IO)." + nl + nl)
     
-    def writeEnum(self, enum_name, enumeration):
-        self.enums.append(enum_name)
-        self.enum_defs.update({enum_name:enumeration})
+    def writeEnum(self, enum):
+        self.enums.append(enum["name"])
+        self.enum_defs.update({enum["name"]:enum["values"]})
         self.written_enums = []
     
     def writeArityZeroEnum(self, enum_name, enumeration):
         self.small_types += ":- type " + enum_name + " ---> "
         l = len(enumeration)
         if l == 0:
-            self.small_types += enum_name + "_unit." + nl + nl
+            self.small_types += enum_name + "_unit." + self.nl + self.nl
         elif l == 1:
-            self.small_types += enumeration[0] + "." + nl + nl
+            self.small_types += enumeration[0] + "." + self.nl + self.nl
         else:
             values = sorted(enumeration)
-            self.small_types += nl
-            foreign_export = ':- pragma foreign_decl("C",'+nl
-            foreign_enum = ':- pragma foreign_enum("C",'+enum_name+'/0,['+nl
-            foreign_export += tab + '"enum Enum' + capitalize(enum_name) + "Type{" + nl
+            self.small_types += self.nl
+            foreign_export = ':- pragma foreign_decl("C",'+self.nl
+            foreign_enum = ':- pragma foreign_enum("C",'+enum_name+'/0,['+self.nl
+            foreign_export += self.tab + '"enum Enum' + capitalize(enum_name) + "Type{" + self.nl
             for e in values[:-1]:
-                self.small_types += tab + e + " ;" + nl
-                foreign_export += tab + "e" + capitalize(e) + "," + nl
-                foreign_enum += tab + e + ' - "e' + capitalize(e) + '",' + nl
-            self.small_types += tab + values[-1] + "." + nl + nl
+                self.small_types += self.tab + e + " ;" + self.nl
+                foreign_export += self.tab + "e" + capitalize(e) + "," + self.nl
+                foreign_enum += self.tab + e + ' - "e' + capitalize(e) + '",' + self.nl
+            self.small_types += self.tab + values[-1] + "." + self.nl + self.nl
             e = capitalize(values[-1])
-            foreign_export += tab + "e" + e + nl + '};").' + nl
-            foreign_enum += tab + values[-1] + ' - "e' + e + '"]).' + nl
+            foreign_export += self.tab + "e" + e + self.nl + '};").' + self.nl
+            foreign_enum += self.tab + values[-1] + ' - "e' + e + '"]).' + self.nl
             self.foreign_exports += [foreign_export, foreign_enum]
 
     def writeEnumType(self, enum_name):
@@ -666,39 +2411,73 @@ write_string(Str, I, N, !IO) :-
         self.written_enums.append(enum_name)
         enumeration = self.enum_defs[enum_name]
         self.writeArityZeroEnum(enum_name, enumeration)
+        self.writeIndexPreds(enum_name, enumeration, range(len(enumeration)))
+
+    # Converts between the values of an arity zero enum and their indices in
+    # the file with a table lookup, rather than trying each value in turn.
+    # values must be sorted, and indices[i] is the index of values[i].
+    def writeIndexPreds(self, type_name, values, indices):
+        tab = self.tab
+        nl = self.nl
+        from_pred = type_name + "_from_index"
+        to_func = type_name + "_index"
+        text = ":- pred " + from_pred + "(int::in, " + type_name + "::out) is semidet." + nl
+        text += ":- func " + to_func + "(" + type_name + ") = int." + nl
+        # Only enums of two or more values have a foreign_enum to index with.
+        if len(values) == 0:
+            text += from_pred + "(_, " + type_name + "_unit) :- semidet_fail." + nl
+            text += to_func + "(_) = 0." + nl
+        elif len(values) == 1:
+            text += from_pred + "(" + str(indices[0]) + ", " + values[0] + ")." + nl
+            text += to_func + "(" + values[0] + ") = " + str(indices[0]) + "." + nl
+        else:
+            count = max(indices) + 1
+            table = ["-1"] * count
+            for value, index in zip(values, indices):
+                table[index] = "e" + capitalize(value)
+            text += ':- pragma foreign_proc("C", ' + from_pred + "(Index::in, Value::out)," + nl
+            text += tab + "[promise_pure, thread_safe, does_not_affect_liveness, will_not_call_mercury, will_not_throw_exception]," + nl
+            text += tab + '"static const int values[] = {' + ", ".join(table) + "};" + nl
+            text += tab + "SUCCESS_INDICATOR = Index >= 0 && Index < " + str(count) + " && values[Index] >= 0;" + nl
+            text += tab + 'Value = SUCCESS_INDICATOR ? values[Index] : 0;").' + nl
+            text += ':- pragma foreign_proc("C", ' + to_func + "(Value::in) = (Index::out)," + nl
+            text += tab + "[promise_pure, thread_safe, does_not_affect_liveness, will_not_call_mercury, will_not_throw_exception]," + nl
+            text += tab + '"static const int indices[] = {' + ", ".join([str(i) for i in indices]) + "};" + nl
+            text += tab + 'Index = indices[Value];").' + nl
+        self.foreign_exports.append(text + nl)
         
     def writeType(self, name, block):
         if name in self.written_types:
             return
         self.written_types.append(name)
         
-        if "children" in block:
-            child_keys = block["children"].keys()
-            child_keys.sort()
+        # Values of the enum without a child block get a constructor of their own.
+        if block["children"] != None:
+            values = self.enum_defs[block["children"]["enum"]]
+            child_keys = [variant["name"] for variant in block["children"]["variants"]]
             for child in child_keys:
-                if child != "enum":
-                    self.small_types += ":- type " + child + "." + nl
+                self.small_types += ":- type " + child + "." + self.nl
             self.small_types += ":- type " + name + "_data --->"
             first = True
-            children_names = []
-            self.int += ":- func " + name + "_type(" + name + "_data) = " + name + "_type." + nl
+            self.int += ":- func " + name + "_type(" + name + "_data) = " + name + "_type." + self.nl
             self.foreign_exports.append(
-                ':- pragma foreign_export("C", ' + name + '_type(in) = (out), "' + capitalize(self.src_name)+'_Get'+capitalize(name) + 'Type").' + nl)
-            for child in child_keys:
-                if child == "enum":
-                    continue
+                ':- pragma foreign_export("C", ' + name + '_type(in) = (out), "' + capitalize(self.src_name)+'_Get'+capitalize(name) + 'Type").' + self.nl)
+            for value in values:
                 if not first:
                     self.small_types += " ;"
                 first = False
-                self.small_types += nl
-                self.small_types += tab + child + "(" + child + ")"
-                self.converts.append({"name":name, "child":child})
-                children_names.append(child)
-            self.small_types += "." + nl
-            self.writeArityZeroEnum(name + "_type", children_names)
+                self.small_types += self.nl
+                if value in child_keys:
+                    self.small_types += self.tab + value + "(" + value + ")"
+                else:
+                    self.small_types += self.tab + value
+                self.converts.append({"name":name, "child":value, "empty":not (value in child_keys)})
+            self.small_types += "." + self.nl
+            self.writeArityZeroEnum(name + "_type", values)
+            self.writeIndexPreds(name + "_type", values, range(len(values)))
         
-        if len(block) == 0:
-            self.small_types += ":- type " + name + " ---> " + name + "." + nl + nl
+        if block["empty"]:
+            self.small_types += ":- type " + name + " ---> " + name + "." + self.nl + self.nl
         else:
             self.small_types += ":- type " + name + " ---> " + name + "("
             self.int += ":- pred examine_" + name + "("
@@ -706,27 +2485,26 @@ write_string(Str, I, N, !IO) :-
             sig = ""
             n = 0
             first = True
-            keys = block.keys()
-            keys.sort()
-            for key in keys:
-                if key == "enum":
-                    continue
+            # Children come last, as they do in the file.
+            for var in block["fields"]:
                 if not first:
                     sig += ", "
                     args += ", "
                 first = False
-                if key == "children":
-                    sig += name + "_data"
-                    args += capitalize(name)+"Data" + str(n)
-                else:
-                    var = self.getVariable(key, block[key])
-                    sig += var["type"]
-                    args += capitalize(var["type"]) + str(n)
+                sig += self.mercuryType(var)
+                args += capitalize(var["type"]) + str(n)
+                n += 1
+            if block["children"] != None:
+                if not first:
+                    sig += ", "
+                    args += ", "
+                sig += name + "_data"
+                args += capitalize(name)+"Data" + str(n)
                 n += 1
-            self.small_types += sig + ")." + nl + nl
-            self.int += sig + ", " + name + ")." + nl
+            self.small_types += sig + ")." + self.nl + self.nl
+            self.int += sig + ", " + name + ")." + self.nl
             examine_body = "examine_" + name + "("
-            examine_body += args +", " + name + "(" + args + "))." + nl
+            examine_body += args +", " + name + "(" + args + "))." + self.nl
             foreign_export_create =  ':- pragma foreign_export("C", examine_' + name + '('
             foreign_export_get = foreign_export_create
             imode = ""
@@ -737,226 +2515,663 @@ write_string(Str, I, N, !IO) :-
                 omode += "out,"
             imode += "in,out"
             omode += "out,in"
-            self.int += ":- mode examine_" + name + "(" + imode + ") is det." + nl
-            self.int += ":- mode examine_" + name + "(" + omode + ") is det." + nl
-            foreign_export_create += imode +'), "' + capitalize(self.src_name) + "_Create" + capitalize(name) + '").' + nl
-            foreign_export_get += omode +'), "' + capitalize(self.src_name) + "_Get" + capitalize(name) + '").' + nl
+            self.int += ":- mode examine_" + name + "(" + imode + ") is det." + self.nl
+            self.int += ":- mode examine_" + name + "(" + omode + ") is det." + self.nl
+            foreign_export_create += imode +'), "' + capitalize(self.src_name) + "_Create" + capitalize(name) + '").' + self.nl
+            foreign_export_get += omode +'), "' + capitalize(self.src_name) + "_Get" + capitalize(name) + '").' + self.nl
             self.foreign_exports += [examine_body, foreign_export_create, foreign_export_get]            
     
-    def writeBlock(self, block_name, block):
-        # self.writeType(block_name, block)
+    def writeBlock(self, block):
+        block_name = block["name"]
         self.writeType(block_name, block)
         read_pred = "read_" + block_name
         write_pred = "write_" + block_name
 
-        self.int += ":- pred " + write_pred + "(" + block_name + "::in, io.io::di, io.io::uo) is det." + nl + nl
-        self.int += "% " + read_pred + "(Buffer, !ByteIndex, Result)." + nl
-        if len(block) == 0:
-            self.int += ":- pred " + read_pred + "(buffer::in, int::in, int::out, " + block_name + "::out) is det." + nl + nl
-            self.imp += read_pred + "(_, !I, " + block_name + ")." + nl + nl
-            self.imp += write_pred + "(_, !IO)." + nl + nl
+        self.int += ":- pred " + write_pred + "(" + block_name + "::in, io.io::di, io.io::uo) is det." + self.nl + self.nl
+        self.int += "% " + read_pred + "(Buffer, !ByteIndex, Result)." + self.nl
+        if block["empty"]:
+            self.int += ":- pred " + read_pred + "(buffer::in, int::in, int::out, " + block_name + "::out) is det." + self.nl + self.nl
+            self.imp += read_pred + "(_, !I, " + block_name + ")." + self.nl + self.nl
+            self.imp += write_pred + "(_, !IO)." + self.nl + self.nl
             return
 
         # Write reader
-        self.int += ":- pred " + read_pred + "(buffer::in, int::in, int::out, " + block_name + "::out) is semidet." + nl + nl
+        self.int += ":- pred " + read_pred + "(buffer::in, int::in, int::out, " + block_name + "::out) is semidet." + self.nl + self.nl
 
-        self.imp += read_pred + "(Buffer, I0, IOut, Out) :- " + nl
+        self.imp += read_pred + "(Buffer, I0, IOut, Out) :- " + self.nl
         # Get all the values...
         i = 1
         istr = "I0"
         istrnext = "I1"
-        size = 0
-        keys = block.keys()
-        keys.sort()
-        for key in keys:
-            if key == "children":
-                self.imp += tab + "get_8(Buffer, " + istr + ", Byte" + istr + ")," + nl
-                self.imp += tab + "(" + nl
-                first = True
-                n = 0
-                child_keys = block["children"].keys()
-                child_keys.sort()
-                for child in child_keys:
-                    if child == "enum":
-                        continue
-
-                    self.writeType(child, block["children"][child])
-                    if not first:
-                        self.imp += tab + ";" + nl
-                    first = False
-                    self.imp += tab + tab + "Byte" + istr + " = " + str(n) + "," + nl
-                    self.imp += tab + tab + "read_" + child + "(Buffer, " + istr + "+1, " + istrnext + ", Child_" + child + ")," + nl
-                    self.imp += tab + tab + "Child = " + child + "(Child_" + child + ")" + nl
-                    n += 1
-                self.imp += tab + ")," + nl
-
-                i += 1
-                istr = istrnext
-                istrnext = "I" + str(i)
+        for var in block["fields"]:
+            key = var["name"]
+            t = var["type"]
+            if var["kind"] == "array":
+                self.useSized(t)
+                if not (t in self.array_types):
+                    self.array_types.append(t)
+                self.imp += self.tab + "get_byte_32(Buffer, " + istr + ", Count" + istr + ")," + self.nl
+                self.imp += self.tab + "Count" + istr + " >= 0," + self.nl
+                self.imp += self.tab + "read_" + t + "_array(Buffer, " + istr + " + 4, Count" + istr + ", " + capitalize(key) + ")," + self.nl
+                self.imp += self.tab + istrnext + " = " + istr + " + 4 + Count" + istr + " * " + str(var["size"]) + "," + self.nl
+            elif var["kind"] == "string":
+                self.imp += self.tab + "get_8(Buffer, " + istr + ", TextSize" + istr + ")," + self.nl
+                self.imp += self.tab + "get_ascii_string(Buffer, " + istr + "+1, TextSize" + istr + ", " + capitalize(key) + ")," + self.nl
+                self.imp += self.tab + istrnext + " - 1 = TextSize" + istr + " + " + istr + "," + self.nl
+            elif var["kind"] == "enum":
+                self.writeEnumType(t)
+                self.imp += self.tab + "get_byte_32(Buffer, " + istr + ", Int" + istr + ")," + self.nl
+                self.imp += self.tab + t + "_from_index(Int" + istr + ", " + capitalize(key) + ")," + self.nl
+                self.imp += self.tab + istrnext + " - 4 = " + istr + "," + self.nl
+            elif t == "int":
+                self.imp += self.tab + "get_byte_32(Buffer, "+istr+", "+capitalize(key) + ")," + self.nl
+                self.imp += self.tab + istrnext + " - 4 = " + istr + "," + self.nl
+            elif t == "float":
+                self.imp += self.tab + "get_byte_float(Buffer, "+istr+", "+capitalize(key) + ")," + self.nl
+                self.imp += self.tab + istrnext + " - 4 = " + istr + "," + self.nl
             else:
-                var = self.getVariable(key, block[key])
-                t = var["type"]
-                if t == "string":
-                    self.imp += tab + "get_8(Buffer, " + istr + ", TextSize" + istr + ")," + nl
-                    self.imp += tab + "get_ascii_string(Buffer, " + istr + "+1, TextSize" + istr + ", " + capitalize(key) + ")," + nl
-                    self.imp += tab + istrnext + " - 1 = TextSize" + istr + " + " + istr + "," + nl
-                    i += 1
-                    istr = istrnext
-                    istrnext = "I" + str(i)
-                elif t in self.enums:
-                    self.writeEnumType(t)
-                    self.imp += tab + "get_byte_8(Buffer, " + istr + ", Int" + istr + ")," + nl
-                    self.imp += tab + "(" + nl
-                    n = 0
-                    for e in self.enum_defs[t]:
-                        if n != 0:
-                            self.imp += tab + ";" + nl
-                        self.imp += tab + tab + "Int" + istr + " = " + str(n) + "," + nl
-                        self.imp += tab + tab + capitalize(key) + " = " + e + nl
-                        n += 1
-                    self.imp += tab + ")," + nl
-                    self.imp += tab + istrnext + " - 1 = " + istr + "," + nl
-                    i += 1
-                    istr = istrnext
-                    istrnext = "I" + str(i)
-                else:
-                    if t == "int":
-                        self.imp += tab + "get_byte_32(Buffer, "+istr+", "+capitalize(key) + ")," + nl
-                        self.imp += tab + istrnext + " - 4 = " + istr + "," + nl
-                    elif t == "float":
-                        self.imp += tab + "get_byte_float(Buffer, "+istr+", "+capitalize(key) + ")," + nl
-                        self.imp += tab + istrnext + " - 4 = " + istr + "," + nl
-                    else:
-                        self.imp += tab + "read_" + t + "(Buffer, " + istr + ", " + istrnext + ", " + capitalize(key) + ")," + nl
-                    i += 1
-                    istr = istrnext
-                    istrnext = "I" + str(i)
-        self.imp += tab + "IOut = " + istr + "," + nl
+                self.useSized(t)
+                self.imp += self.tab + "get_" + t + "(Buffer, " + istr + ", " + capitalize(key) + ")," + self.nl
+                self.imp += self.tab + istrnext + " - " + str(var["size"]) + " = " + istr + "," + self.nl
+            i += 1
+            istr = istrnext
+            istrnext = "I" + str(i)
 
-        self.imp += tab + "Out = " + block_name + "("
+        if block["children"] != None:
+            self.imp += self.tab + "get_8(Buffer, " + istr + ", Byte" + istr + ")," + self.nl
+            self.imp += self.tab + block_name + "_type_from_index(Byte" + istr + ", Type" + istr + ")," + self.nl
+            self.imp += self.tab + "(" + self.nl
+            variants = dict([(variant["name"], variant["block"]) for variant in block["children"]["variants"]])
+            first = True
+            for child in self.enum_defs[block["children"]["enum"]]:
+                if not first:
+                    self.imp += self.tab + ";" + self.nl
+                first = False
+                self.imp += self.tab + self.tab + "Type" + istr + " = " + child + "," + self.nl
+                if not (child in variants):
+                    self.imp += self.tab + self.tab + istrnext + " = " + istr + "+1," + self.nl
+                    self.imp += self.tab + self.tab + "Child = " + child + self.nl
+                    continue
+                self.writeType(child, variants[child])
+                self.imp += self.tab + self.tab + "read_" + child + "(Buffer, " + istr + "+1, " + istrnext + ", Child_" + child + ")," + self.nl
+                self.imp += self.tab + self.tab + "Child = " + child + "(Child_" + child + ")" + self.nl
+            self.imp += self.tab + ")," + self.nl
+            i += 1
+            istr = istrnext
+            istrnext = "I" + str(i)
+        self.imp += self.tab + "IOut = " + istr + "," + self.nl
 
-        first = True
-        guts = ""
-        for key in keys:
-            if not first:
+        self.imp += self.tab + "Out = " + block_name + "("
+
+        guts = ", ".join([capitalize(var["name"]) for var in block["fields"]])
+        if block["children"] != None:
+            if len(guts) != 0:
                 guts += ", "
-            first = False
-            if key == "children":
-                guts += "Child"
-            else:
-                guts += capitalize(key)
-        self.imp += guts + ")." + nl + nl
+            guts += "Child"
+        self.imp += guts + ")." + self.nl + self.nl
 
         # Write writer
-        self.imp += write_pred + "(" + block_name + "(" + guts + "), !IO) :-" + nl
-        for key in keys:
-            if key == "children":
-                self.imp += tab + "(" + nl
-                n = 0
-                child_keys = block["children"].keys()
-                child_keys.sort()
-                for child in child_keys:
-                    if child == "enum":
-                        continue
-                    if n != 0:
-                        self.imp += tab + ";" + nl
-                    self.imp += tab + tab + "Child = " + child + "(Child" + capitalize(child) + "), io.write_byte(" + str(n) + ", !IO)," + nl
-                    self.imp += tab + tab + "write_" + child + "(Child" + capitalize(child) + ", !IO)" + nl
-                    n += 1
-                self.imp += tab + ")," + nl
+        self.imp += write_pred + "(" + block_name + "(" + guts + "), !IO) :-" + self.nl
+        for var in block["fields"]:
+            ckey = capitalize(var["name"])
+            t = var["type"]
+            if var["kind"] == "array":
+                self.imp += self.tab + "write_" + t + "_array(" + ckey + ", !IO)," + self.nl
+            elif var["kind"] == "string":
+                self.imp += self.tab + "string.length(" + ckey + ") = 0+Len" + ckey + "," + self.nl
+                self.imp += self.tab + "io.write_byte(Len" + ckey + ", !IO)," + self.nl
+                self.imp += self.tab + "write_string(" + ckey + ", 0, Len" + ckey + ", !IO)," + self.nl
+            elif var["kind"] == "enum" or t == "float" or t == "int":
+                if var["kind"] == "enum":
+                    self.imp += self.tab + "Int" + ckey + " = " + t + "_index(" + ckey + ")," + self.nl
+                    self.imp += self.tab + "int_to_bytes(Int" + ckey
+                elif t == "float":
+                    self.imp += self.tab + "float_to_bytes(" + ckey
+                else:
+                    self.imp += self.tab + "int_to_bytes(" + ckey
+                i = 0
+                while i < 4:
+                    self.imp += ","+ckey+str(i)
+                    i += 1
+                self.imp += ")," + self.nl
+                i = 0
+                while i < 4:
+                    self.imp += self.tab + "io.write_byte(" + ckey + str(i) + ", !IO)," + self.nl
+                    i += 1
             else:
-                ckey = capitalize(key)
-                var = self.getVariable(key, block[key])
-                t = var["type"]
-                if t == "string":
-                    self.imp += tab + "string.length(" + ckey + ") = 0+Len" + ckey + "," + nl
-                    self.imp += tab + "io.write_byte(Len" + ckey + ", !IO)," + nl
-                    self.imp += tab + "write_string(" + ckey + ", 0, Len" + ckey + ", !IO)," + nl
-                elif t == "float" or t == "int":
-                    if t == "float":
-                        self.imp += tab + "float_to_bytes(" + ckey
-                    elif t == "int":
-                        self.imp += tab + "int_to_bytes(" + ckey
-                    else:
-                        print ("INTERNAL ERROR: Invalid type " + t)
-                        quit()
-                    i = 0
-                    while i < 4:
-                        self.imp += ","+ckey+str(i)
-                        i += 1
-                    self.imp += ")," + nl
-                    i = 0
-                    while i < 4:
-                        self.imp += tab + "io.write_byte(" + ckey + str(i) + ", !IO)," + nl
-                        i += 1
-                    pass
-                elif t in self.enums:
-                    self.imp += tab + "(" + nl
-                    n = 0
-                    for e in self.enum_defs[t]:
-                        if n != 0:
-                            self.imp += tab + ";" + nl
-                        self.imp += tab + tab + ckey + " = " + e + ", io.write_byte(" + str(n) + ", !IO)" + nl
-                        n += 1
-                    self.imp += tab + ")," + nl
+                self.imp += self.tab + "put_" + t + "(" + ckey + ", !IO)," + self.nl
+        if block["children"] != None:
+            self.imp += self.tab + "io.write_byte(" + block_name + "_type_index(" + block_name + "_type(Child)), !IO)," + self.nl
+            self.imp += self.tab + "(" + self.nl
+            variants = [variant["name"] for variant in block["children"]["variants"]]
+            first = True
+            for child in self.enum_defs[block["children"]["enum"]]:
+                if not first:
+                    self.imp += self.tab + ";" + self.nl
+                first = False
+                if not (child in variants):
+                    self.imp += self.tab + self.tab + "Child = " + child + self.nl
+                    continue
+                self.imp += self.tab + self.tab + "Child = " + child + "(Child" + capitalize(child) + ")," + self.nl
+                self.imp += self.tab + self.tab + "write_" + child + "(Child" + capitalize(child) + ", !IO)" + self.nl
+            self.imp += self.tab + ")," + self.nl
+        self.imp += self.tab + "true." + self.nl + self.nl
+
+        if block["children"] != None:
+            for variant in block["children"]["variants"]:
+                self.writeBlock(variant["block"])
+
+# Plan Writer, compiles the schema into a decode plan for bottle-dump
+# Plans follow the C layout: fields in sorted order, then the children tag and
+# the selected child. Runs of fixed-size fields are merged into one unpack.
+PLAN_VERSION = 2
+PLAN_FORMATS = {"int":"i", "float":"f", "double":"d",
+    "u8":"B", "i8":"b", "u16":"H", "i16":"h", "u32":"I", "i32":"i", "u64":"Q", "i64":"q"}
+ENUM_FORMAT = "I"
+TAG_FORMAT = "B"
+COUNT_FORMAT = "I"
+ARRAY_PREVIEW = 8
+
+class PlanWriter(Writer):
+    def __init__(self, name):
+        Writer.__init__(self, name)
+        self.enum_defs = {}
+        self.blocks = {}
+
+    def open(self, name):
+        pass
+
+    def close(self):
+        pass
+
+    def writeEnum(self, enum):
+        self.enums.append(enum["name"])
+        self.enum_defs[enum["name"]] = enum["values"]
+
+    def compileBlock(self, block):
+        ops = []
+        names = []
+        fmt = ""
+        enums = []
+        for var in block["fields"]:
+            t = var["type"]
+            if var["kind"] == "string" or var["kind"] == "array":
+                if len(names) != 0:
+                    ops.append(("fixed", names, "=" + fmt, enums))
+                    names, fmt, enums = [], "", []
+                if var["kind"] == "string":
+                    ops.append(("string", var["name"]))
                 else:
-                    self.imp += tab + "write_" + t + "(" + ckey + ", !IO)," + nl
-        self.imp += tab + "true." + nl + nl
+                    ops.append(("array", var["name"], PLAN_FORMATS[t], var["size"]))
+                continue
+            elif var["kind"] == "enum":
+                fmt += ENUM_FORMAT
+                enums.append(self.enum_defs[t])
+            else:
+                fmt += PLAN_FORMATS[t]
+                enums.append(None)
+            names.append(var["name"])
+        if len(names) != 0:
+            ops.append(("fixed", names, "=" + fmt, enums))
+        if block["children"] != None:
+            ops.append(self.compileChildren(block["children"]))
+        return ops
 
-        if "children" in block:
-            child_keys = block["children"].keys()
-            child_keys.sort()
-            for child in child_keys:
-                if child == "enum":
-                    continue
-                self.writeBlock(child, block["children"][child])
+    # The table is indexed by tag, with empty ops for values with no child.
+    def compileChildren(self, children):
+        enum_name = children["enum"]
+        table = [(value, []) for value in self.enum_defs[enum_name]]
+        for variant in children["variants"]:
+            table[variant["tag"]] = (variant["name"], self.compileBlock(variant["block"]))
+        return ("children", enum_name, table)
+
+    def writeBlock(self, block):
+        self.blocks[block["name"]] = self.compileBlock(block)
+
+def loadPlan(schema_path):
+    plan_path = os.path.splitext(schema_path)[0] + ".bottleplan"
+    st = os.stat(schema_path)
+    stamp = (PLAN_VERSION, st.st_mtime, st.st_size)
+    try:
+        plan_file = open(plan_path, "rb")
+        try:
+            cached = pickle.load(plan_file)
+        finally:
+            plan_file.close()
+        if cached["stamp"] == stamp:
+            return cached["blocks"]
+    except Exception:
+        pass
+
+    infile = open(schema_path, "rb")
+    schema = json.loads(infile.read())
+    infile.close()
+    if not (type(schema) is dict):
+        raise BottleError("Input has no name property")
+    planner = PlanWriter(schema.get("name", ""))
+    writeSchema(planner, compileSchema(schema))
+
+    # The cache is only an optimization, so a read-only schema dir is fine.
+    try:
+        plan_file = open(plan_path, "wb")
+        pickle.dump({"stamp":stamp, "blocks":planner.blocks}, plan_file, 2)
+        plan_file.close()
+    except (IOError, OSError):
+        pass
+    return planner.blocks
+
+# Reads a data file in fixed chunks, keeping only the unread tail in memory.
+class DumpStream:
+    def __init__(self, file, chunk = 64 * 1024):
+        self.file = file
+        self.chunk = chunk
+        self.buf = b""
+        self.pos = 0
+        self.offset = 0
+
+    def fill(self, n):
+        self.buf = self.buf[self.pos:]
+        self.offset += self.pos
+        self.pos = 0
+        while len(self.buf) < n:
+            data = self.file.read(max(self.chunk, n - len(self.buf)))
+            if len(data) == 0:
+                return False
+            self.buf += data
+        return True
+
+    # Skips n bytes without holding more than one chunk of them.
+    def skip(self, n):
+        while n > 0:
+            if self.pos == len(self.buf) and not self.fill(1):
+                raise EOFError("Truncated record at offset " + str(self.tell()))
+            step = min(n, len(self.buf) - self.pos)
+            self.pos += step
+            n -= step
+
+    def read(self, n):
+        if self.pos + n > len(self.buf) and not self.fill(n):
+            raise EOFError("Truncated record at offset " + str(self.tell()))
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def unpack(self, fmt, size):
+        if self.pos + size > len(self.buf) and not self.fill(size):
+            raise EOFError("Truncated record at offset " + str(self.tell()))
+        values = struct.unpack_from(fmt, self.buf, self.pos)
+        self.pos += size
+        return values
+
+    def tell(self):
+        return self.offset + self.pos
+
+    def atEnd(self):
+        return self.pos == len(self.buf) and not self.fill(1)
+
+# Enum values are decoded to their names, which are printed bare unlike strings.
+class EnumName(str):
+    pass
+
+def decodeRecord(stream, ops, out, variants, path):
+    for op in ops:
+        if op[0] == "fixed":
+            values = stream.unpack(op[2], struct.calcsize(op[2]))
+            i = 0
+            for name in op[1]:
+                value = values[i]
+                if op[3][i] != None:
+                    if value < len(op[3][i]):
+                        value = EnumName(op[3][i][value])
+                    else:
+                        value = EnumName("<invalid " + str(value) + ">")
+                out.append((name, value))
+                i += 1
+        elif op[0] == "string":
+            length = stream.unpack("=" + TAG_FORMAT, 1)[0]
+            out.append((op[1], stream.read(length)))
+        elif op[0] == "array":
+            count = stream.unpack("=" + COUNT_FORMAT, 4)[0]
+            shown = min(count, ARRAY_PREVIEW)
+            values = list(stream.unpack("=" + op[2] * shown, op[3] * shown))
+            stream.skip((count - shown) * op[3])
+            if shown < count:
+                values.append("...")
+            out.append((op[1] + "[" + str(count) + "]", values))
+        else:
+            tag = stream.unpack("=" + TAG_FORMAT, 1)[0]
+            if tag >= len(op[2]):
+                raise ValueError("Invalid " + op[1] + " tag " + str(tag) + " at offset " + str(stream.tell() - 1))
+            value, child_ops = op[2][tag]
+            child_path = path + "." + value
+            variants[child_path] = variants.get(child_path, 0) + 1
+            child = []
+            decodeRecord(stream, child_ops, child, variants, child_path)
+            out.append((op[1], (value, child)))
+
+def formatRecord(fields):
+    parts = []
+    for name, value in fields:
+        if type(value) is tuple and len(value[1]) == 0:
+            parts.append(name + "=" + value[0])
+        elif type(value) is tuple:
+            parts.append(name + "=" + value[0] + " { " + formatRecord(value[1]) + " }")
+        elif type(value) is list:
+            parts.append(name + "=[" + ", ".join([str(v) for v in value]) + "]")
+        elif type(value) is EnumName:
+            parts.append(name + "=" + value)
+        elif type(value) is bytes:
+            parts.append(name + "=" + json.dumps(value.decode("utf-8", "replace")))
+        else:
+            parts.append(name + "=" + str(value))
+    return " ".join(parts)
+
+def printHistogram(sizes):
+    if len(sizes) == 0:
+        return
+    most = max(sizes.values())
+    for bucket in sorted(sizes.keys()):
+        bar = "#" * max(1, (sizes[bucket] * 40) // most)
+        print ("    <= %-10d %10d %s" % (bucket, sizes[bucket], bar))
+
+def dump(schema_path, block_name, data_paths, records = True):
+    try:
+        plan = loadPlan(schema_path)
+    except (BottleError, IOError, OSError) as e:
+        print (schema_path + ": " + str(e))
+        return 1
+    except ValueError as e:
+        print (schema_path + ": Invalid JSON: " + str(e))
+        return 1
+    if not (block_name in plan):
+        print ("Schema has no block " + block_name)
+        return 1
+    ops = plan[block_name]
+    status = 0
+    for data_path in data_paths:
+        try:
+            data_file = open(data_path, "rb")
+        except (IOError, OSError) as e:
+            print (data_path + ": " + str(e))
+            status = 1
+            continue
+        stream = DumpStream(data_file)
+        variants = {}
+        sizes = {}
+        n = 0
+        try:
+            while not stream.atEnd():
+                start = stream.tell()
+                fields = []
+                decodeRecord(stream, ops, fields, variants, block_name)
+                size = stream.tell() - start
+                bucket = 1
+                while bucket < size:
+                    bucket *= 2
+                sizes[bucket] = sizes.get(bucket, 0) + 1
+                if records:
+                    print (block_name + " #" + str(n) + " @" + str(start) + ": " + formatRecord(fields))
+                n += 1
+        except (EOFError, ValueError) as e:
+            print (data_path + ": " + str(e))
+            status = 1
+        data_file.close()
+
+        print (data_path + ": " + str(n) + " " + block_name + " records, " + str(stream.tell()) + " bytes")
+        for path in sorted(variants.keys()):
+            print ("    %-40s %10d" % (path, variants[path]))
+        print ("Record sizes:")
+        printHistogram(sizes)
+    return status
 
 # Generation functions and main
 
-def help():
-    if len(sys.argv) == 0:
-        name = "generate.py"
+def iop(i, p):
+    return (i == "-" + p[0]) or (i == "--" + p) or (i == p[0]) or (i == p)
+
+def languageFor(name):
+    l = name.lower()
+    if l == "c++" or l == "cpp" or l == "cxx":
+        return CPPLANG
+    elif l == "c":
+        return CLANG
+    elif iop(l, "mercury"):
+        return MLANG
+    elif iop(l, "json"):
+        return JSON
+    return None
+
+# Feeds a compiled schema to a writer, enums first so blocks can refer to them.
+def writeSchema(writer, schema):
+    if schema["has_enums"]:
+        writer.beginEnums()
+        for e in schema["enums"]:
+            writer.writeEnum(e)
+        writer.endEnums()
+
+    if schema["has_blocks"]:
+        writer.beginBlocks()
+        for b in schema["blocks"]:
+            writer.writeBlock(b)
+        writer.endBlocks()
+
+def depfileEscape(path):
+    return path.replace("\\", "\\\\").replace(" ", "\\ ").replace("#", "\\#").replace("$", "$$")
+
+# Writes a make/ninja depfile saying every output depends on the inputs and on
+# the generator itself.
+def writeDepfile(path, outputs, inputs):
+    generator = os.path.abspath(__file__)
+    if generator.endswith(".pyc"):
+        generator = generator[:-1]
+    depfile = open(path, "wb")
+    depfile.write(" ".join([depfileEscape(o) for o in outputs]) + ":")
+    for i in inputs + [generator]:
+        depfile.write(" \\\n    " + depfileEscape(i))
+    depfile.write("\n")
+    depfile.close()
+
+# Generates code for an already parsed schema. lang is one of the language
+# constants or a name accepted by --lang. If depends is a list of input files,
+# a depfile listing them is also written as <name>.d in out_dir. project maps
+# block names to the fields --project reads for them. Returns a list of error
+# messages, which is empty on success.
+def generate(schema, lang = CLANG, out_dir = ".", tab = "    ", nl = "\n", out_of_line = None, depends = None, project = None):
+    if not (lang in (CLANG, MLANG, JSON, CPPLANG)):
+        lang_name = str(lang)
+        lang = languageFor(lang_name)
+        if lang == None:
+            return ["Invalid language: " + lang_name]
+
+    if not (type(schema) is dict) or not ("name" in schema):
+        return ["Input has no name property"]
+    name = str(schema["name"])
+
+    # Compiled before any output is opened, so an invalid schema leaves the
+    # previous outputs alone.
+    try:
+        compiled = compileSchema(schema)
+    except BottleError as e:
+        return [str(e)]
+
+    if lang == CLANG:
+        writer = CWriter(name, tab, nl, out_dir, out_of_line, project)
+    elif lang == MLANG:
+        writer = MWriter(name, tab, nl, out_dir)
+    elif lang == CPPLANG:
+        writer = CPPWriter(name, tab, nl, out_dir)
     else:
-        name = sys.argv[0]
+        writer = JSONWriter(name, tab, nl, out_dir)
+
+    try:
+        writer.open(name)
+        writeSchema(writer, compiled)
+        writer.close()
+        writer.commit()
+        if depends != None:
+            writeDepfile(os.path.join(out_dir, name + ".d"), writer.outputs, depends)
+    except BottleError as e:
+        return [str(e)]
+    except (IOError, OSError) as e:
+        return [str(e)]
+    finally:
+        writer.discard()
+    return []
+
+def loadSchema(input):
+    infile = open(input, "rb")
+    try:
+        return json.loads(infile.read())
+    finally:
+        infile.close()
+
+def generateFile(input, lang = CLANG, out_dir = ".", tab = "    ", nl = "\n", out_of_line = None, depfile = False, project = None):
+    try:
+        schema = loadSchema(input)
+    except (IOError, OSError) as e:
+        return [str(e)]
+    except ValueError as e:
+        return ["Invalid JSON: " + str(e)]
+    if depfile:
+        return generate(schema, lang, out_dir, tab, nl, out_of_line, [input], project)
+    return generate(schema, lang, out_dir, tab, nl, out_of_line, None, project)
+
+# Polls the inputs and regenerates a schema's outputs only when it actually
+# changed. Parsed schemas are kept, so edits that don't change the parsed
+# schema (formatting, key order) don't touch the outputs. Runs until
+# interrupted.
+def watch(inputs, lang = CLANG, out_dir = ".", tab = "    ", nl = "\n", out_of_line = None, depfile = False, interval = 0.5, project = None):
+    stamps = {}
+    schemas = {}
+    try:
+        while True:
+            for input in inputs:
+                try:
+                    st = os.stat(input)
+                except OSError as e:
+                    if stamps.get(input) != None:
+                        print (input + ": " + str(e))
+                    stamps[input] = None
+                    continue
+                stamp = (st.st_mtime, st.st_size)
+                if stamps.get(input) == stamp:
+                    continue
+                stamps[input] = stamp
+                try:
+                    schema = loadSchema(input)
+                except (IOError, OSError, ValueError) as e:
+                    print (input + ": " + str(e))
+                    continue
+                if schemas.get(input) == schema:
+                    continue
+                if depfile:
+                    errors = generate(schema, lang, out_dir, tab, nl, out_of_line, [input], project)
+                else:
+                    errors = generate(schema, lang, out_dir, tab, nl, out_of_line, None, project)
+                for error in errors:
+                    print (input + ": " + error)
+                if len(errors) == 0:
+                    schemas[input] = schema
+                    print ("Generated " + input)
+                else:
+                    schemas.pop(input, None)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def help(name):
     print ("USAGE: " + name + " [OPTIONS] INPUT")
     print ("OPTIONS:")
     print ("    --help, -h")
     print ("        Displays this help message and exits")
     print ("    --lang LANG, -lLANG")
-    print ("        Sets the output language. Choices are c, m[ercury], or j[son]")
+    print ("        Sets the output language. Choices are c, c++, m[ercury], or j[son]")
     print ("    --nl {DOS|UNIX}, -n{d|u}")
     print ("        Sets line endings to dos or unix. Default is unix.")
-    print ("    --tabs N, -t[n]")
-    print ("        Use N spaces for tabs, or if zero (or just -t) use tab characters")
+    print ("    --tabs N, -tN")
+    print ("        Use N spaces for tabs, or if zero use tab characters")
+    print ("    --out-dir DIR, -ODIR")
+    print ("        Writes the generated files to DIR instead of the current directory")
+    print ("    --MD")
+    print ("        Also writes a make/ninja depfile, NAME.d, next to each schema's outputs")
+    print ("    --watch, -w")
+    print ("        Keeps running and regenerates the outputs of each input when it changes")
+    print ("    --out-of-line VARIANT[,VARIANT...], -oVARIANT")
+    print ("        C only. Stores the named children variants behind a pointer instead of")
+    print ("        inside the union, so rarely used large variants don't bloat every struct")
+    print ("    --project BLOCK:FIELD[,FIELD...], -pBLOCK:FIELD")
+    print ("        C only. Also generates Bottle_ProjectBLOCKFile/Mem, which only read the")
+    print ("        named fields of BLOCK and skip the rest. Name children to read them too")
+    print ("    --dump BLOCK, -dBLOCK")
+    print ("        bottle-dump mode. Decodes DATA files as BLOCK records using the schema:")
+    print ("            " + name + " --dump BLOCK SCHEMA DATA...")
+    print ("        Prints each record, the count of each variant, and a record size")
+    print ("        histogram. The compiled schema is cached next to it as .bottleplan")
+    print ("    --stats, -s")
+    print ("        With --dump, only print the variant counts and size histogram")
 
-def iop(i, p):
-    return (i == "-" + p[0]) or (i == "--" + p) or (i == p[0]) or (i == p)
+def main(argv):
+    if len(argv) == 0:
+        name = "generate.py"
+    else:
+        name = argv[0]
+
+    if len(argv) < 2:
+        help(name)
+        return 0
+
+    try:
+        opts, args = getopt.getopt(argv[1:], 'ht:l:n:d:so:O:wp:',
+            ["lang=", "nl=", "tabs=", "help", "dump=", "stats", "out-of-line=", "out-dir=", "MD", "watch", "project="])
+    except getopt.GetoptError as e:
+        print (str(e))
+        return 1
 
-if len(sys.argv) < 2:
-    help()
-    quit()
-else:
-    opts, args = getopt.getopt(sys.argv[1:], 'ht:l:n:', ["lang=", "nl=", "tabs=", "help"])
     for opt, x in opts:
         if iop(opt, "help"):
-            help()
-            quit()
+            help(name)
+            return 0
     
     if len(args) == 0:
         print ("No input files specified")
+        return 1
     
+    lang = CLANG
+    tab = "    "
+    nl = "\n"
+    out_dir = "."
+    out_of_line = []
+    project = {}
+    depfile = False
+    watching = False
+    dump_block = None
+    dump_records = True
     for opt, val in opts:
         l = val.lower()
+        if opt == "--MD":
+            depfile = True
+        if iop(opt, "watch"):
+            watching = True
+        if iop(opt, "dump"):
+            dump_block = val
+        if iop(opt, "stats"):
+            dump_records = False
+        if iop(opt, "out-of-line"):
+            out_of_line += val.split(",")
+        if iop(opt, "project"):
+            if not (":" in val):
+                print ("Invalid projection: " + val)
+                return 1
+            block_name, fields = val.split(":", 1)
+            project[block_name] = project.get(block_name, []) + fields.split(",")
+        if opt == "-O" or opt == "--out-dir":
+            out_dir = val
         if iop(opt, "lang"):
-            if iop(l, "c++") or l == "c":
-                lang = CLANG
-            elif iop(l, "mercury"):
-                lang = MLANG
-            elif iop(l, "json"):
-                lang = JSON
-            else:
+            lang = languageFor(l)
+            if lang == None:
                 print ("Invalid language: " + l)
-                quit()
+                return 1
         if iop(opt, "nl"):
             if iop(l, "dos") or iop(l, "windows") or iop(l, "msdos") or l == "ms-dos":
                 nl = "\r\n"
@@ -964,63 +3179,34 @@ else:
                 nl = "\n"
             else:
                 print ("Invalid line ending: " + l)
-                quit()
+                return 1
         if iop(opt, "tabs"):
-            if val == "":
-                tab = "\n"
+            try:
+                n = int(val)
+            except ValueError:
+                print ("Invalid tabs: " + val)
+                return 1
+            if n == 0:
+                tab = "\t"
             else:
-                try:
-                    n = int(val)
-                    if n == 0:
-                        tab = "\n"
-                    else:
-                        tab = ""
-                        i = 0
-                        while i < n:
-                            tab += ""
-                except:
-                    print ("Invalid tabs: " + val)
-                    quit()
+                tab = " " * n
 
-    if len(args) == 0:
-        quit()
+    if dump_block != None:
+        if len(args) < 2:
+            print ("bottle-dump needs a schema and at least one data file")
+            return 1
+        return dump(args[0], dump_block, args[1:], dump_records)
+
+    if watching:
+        return watch(args, lang, out_dir, tab, nl, out_of_line, depfile, 0.5, project)
 
     # Do actual parsing
+    status = 0
     for input in args:
-        infile = open(input, "rb")
-        input_object = json.loads(infile.read())
-        if not ("name" in input_object):
-            print ("Input has no name property")
-            quit()
-        else:
-            name = input_object["name"]
-        if lang == CLANG:
-            writer = CWriter(name)
-        elif lang == MLANG:
-            writer = MWriter(name)
-        elif lang == JSON:
-            writer = JSONWriter(name)
-        else:
-            print ("INTERNAL ERROR: Invalid language " + str(lang))
-            quit()
-        
-        writer.open(str(name))
-        
-        # Write all enums
-        if "enums" in input_object:
-            enums = input_object["enums"]
-            writer.beginEnums()
-            for e in enums:
-                writer.writeEnum(e, enums[str(e)])
-            writer.endEnums()
-        
-        # Write blocks
-        if "blocks" in input_object:
-            writer.beginBlocks()
-            blocks = input_object["blocks"]
-            for b in blocks:
-                writer.writeBlock(b, blocks[str(b)])
-            writer.endBlocks()
-        
-        writer.close()
-        
+        for error in generateFile(input, lang, out_dir, tab, nl, out_of_line, depfile, project):
+            print (input + ": " + error)
+            status = 1
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,74 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import generate
+
+def findCompiler():
+    for cc in ("cc", "gcc", "clang"):
+        for path in os.environ.get("PATH", "").split(os.pathsep):
+            if os.path.isfile(os.path.join(path, cc)):
+                return cc
+    return None
+
+CC = findCompiler()
+
+# Loads a u16 array whose count is cut off after 2 bytes. The bytes past len
+# make a count of 16M, so reading it would copy far past the buffer.
+TRUNCATED_U16 = """
+#include "shape.h"
+#include <string.h>
+int main(void){
+    static const unsigned char mem[] = {2, 0, 0, 1, 0, 0, 0, 0};
+    struct BottleShape shape;
+    memset(&shape, 0, sizeof(shape));
+    if(Bottle_LoadShapeMem(&shape, mem, 2) != BOTTLE_FAIL)
+        return 1;
+    if(Bottle_LoadShapeMem(&shape, mem, 6) != BOTTLE_FAIL)
+        return 2;
+    return 0;
+}
+"""
+
+class SchemaTest(unittest.TestCase):
+
+    def testEmptyChildrenEnum(self):
+        schema = {"name":"s", "enums":{"k":[]}, "blocks":{"b":{"x":"int", "children":{"enum":"k"}}}}
+        self.assertRaises(generate.BottleError, generate.compileSchema, schema)
+
+    def testEmptyFieldEnum(self):
+        schema = {"name":"s", "enums":{"k":[]}, "blocks":{"b":{"x":"k"}}}
+        self.assertRaises(generate.BottleError, generate.compileSchema, schema)
+
+    def testEmptyEnumUnused(self):
+        schema = {"name":"s", "enums":{"k":[]}, "blocks":{"b":{"x":"int"}}}
+        self.assertEqual(len(generate.compileSchema(schema)["enums"]), 1)
+
+class CTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def build(self, schema, source):
+        self.assertEqual(generate.generate(schema, generate.CLANG, self.dir), [])
+        main = os.path.join(self.dir, "main.c")
+        with open(main, "w") as out:
+            out.write(source)
+        exe = os.path.join(self.dir, "main")
+        subprocess.check_call([CC, "-o", exe, main, os.path.join(self.dir, schema["name"] + ".c")])
+        return exe
+
+    @unittest.skipIf(CC == None, "no C compiler")
+    def testTruncatedU16Array(self):
+        schema = {"name":"shape", "blocks":{"shape":{"points":{"type":"u16", "array":True}}}}
+        self.assertEqual(subprocess.call([self.build(schema, TRUNCATED_U16)]), 0)
+
+if __name__ == "__main__":
+    unittest.main()